@@ -26,4 +26,8 @@ $(pwd)/venv/bin/python -m pip install uv
 $(pwd)/venv/bin/python -m uv sync
 
 rm -rf report
-$(pwd)/venv/bin/python -m uv run src/mk_report.py bench/json rsrc report
+$(pwd)/venv/bin/python -m uv run src/mk_report.py bench/json rsrc report --cache .egglog-cache --timeout 1200 --jobs "$(nproc)"
+
+# Keep a history of the results across nightly runs and flag regressions
+$(pwd)/venv/bin/python -m uv run src/history.py record report/report.json .bench-history.jsonl
+$(pwd)/venv/bin/python -m uv run src/history.py compare .bench-history.jsonl
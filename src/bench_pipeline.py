@@ -0,0 +1,117 @@
+import argparse
+import io
+import json
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from egglog_runner import run_egglog_program
+from lambda_skia import write_sexp
+from parse_sexp import lark_parser, read_sexp
+from skp_compiler import compile_skp_to_lskia, get_reset_warnings
+from skp_loader import stream_skp
+from verify import Verifier, verify_skp
+
+
+def best_of(f: Callable[[], Any], repeat: int) -> float:
+    """Best wall clock time of `repeat` runs of f, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_compile(benchmark: Path, skp: dict[str, Any], repeat: int) -> dict[str, float]:
+    def run():
+        compile_skp_to_lskia(skp['commands'])
+        get_reset_warnings()
+
+    return {'compile': best_of(run, repeat)}
+
+
+def bench_frontend(benchmark: Path, skp: dict[str, Any], repeat: int) -> dict[str, float]:
+    """Verifying and then compiling, against doing both in one pass. The
+    commands are streamed from the file as in mk_report, so the two passes
+    also read it twice."""
+
+    def two_pass():
+        verify_skp(stream_skp(benchmark))
+        compile_skp_to_lskia(stream_skp(benchmark))
+        get_reset_warnings()
+
+    def fused():
+        verifier = Verifier(stream_skp(benchmark))
+        compile_skp_to_lskia(verifier)
+        get_reset_warnings()
+        if verifier.error is not None:
+            raise ValueError(verifier.error)
+
+    return {'two_pass': best_of(two_pass, repeat), 'fused': best_of(fused, repeat)}
+
+
+def bench_sexp(benchmark: Path, skp: dict[str, Any], repeat: int) -> dict[str, float]:
+    layer, _ = compile_skp_to_lskia(skp['commands'])
+    get_reset_warnings()
+    return {'sexp': best_of(lambda: write_sexp(layer, io.StringIO()), repeat)}
+
+
+def bench_parse(benchmark: Path, skp: dict[str, Any], repeat: int) -> dict[str, float]:
+    """Parses the optimized term, so this needs a working egglog"""
+    layer, _ = compile_skp_to_lskia(skp['commands'])
+    get_reset_warnings()
+    result = run_egglog_program('(let test ' + layer.sexp() + ')')
+    if result.ret_code != 0:
+        raise RuntimeError(result.stderr)
+
+    lark_parser()  # not timing the table construction
+    return {
+        'lark': best_of(lambda: lark_parser().parse(result.output), repeat),
+        'reader': best_of(lambda: read_sexp(result.output), repeat),
+    }
+
+
+STAGES: dict[str, Callable[[Path, dict[str, Any], int], dict[str, float]]] = {
+    'compile': bench_compile,
+    'frontend': bench_frontend,
+    'sexp': bench_sexp,
+    'parse': bench_parse,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time pipeline stages over benchmarks')
+    parser.add_argument('bench', type=Path)
+    parser.add_argument('--stage', choices=STAGES.keys(), default='compile')
+    parser.add_argument(
+        '--largest', type=int, default=None, help='only the N largest captures the stage runs on'
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    benchmarks = sorted(args.bench.glob('*.json'), key=lambda p: p.stat().st_size, reverse=True)
+
+    # Counts only captures the stage runs on, many of the largest fail to compile
+    timed = 0
+    totals: dict[str, float] = {}
+    for benchmark in benchmarks:
+        if args.largest is not None and timed == args.largest:
+            break
+        with benchmark.open('rb') as f:
+            skp = json.load(f)
+
+        try:
+            timings = STAGES[args.stage](benchmark, skp, args.repeat)
+        except Exception as e:
+            print(f'{benchmark.stem:40} {len(skp["commands"]):6} failed: {type(e).__name__}')
+            continue
+
+        cols = '  '.join(f'{name} {1000 * t:9.2f}ms' for name, t in timings.items())
+        print(f'{benchmark.stem:40} {len(skp["commands"]):6}  {cols}')
+        for name, t in timings.items():
+            totals[name] = totals.get(name, 0.0) + t
+        timed += 1
+
+    cols = '  '.join(f'{name} {1000 * t:.2f}ms' for name, t in totals.items())
+    print(f'total over {timed} captures  {cols}')
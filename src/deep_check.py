@@ -0,0 +1,99 @@
+import argparse
+import json
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any
+
+from mk_report import EGG, JSON, Args, arg_parser, run_pipeline
+
+
+def deep_capture(draws: int, layers: int) -> dict[str, Any]:
+    """A capture of `draws` rects one over the other, then `layers` SaveLayers
+    each nested in the last with a rect of its own. The terms it compiles to
+    are as deep as the number of draws and the number of layers. The layers
+    are translucent, so no rewrite removes them; a term that does not change
+    keeps the line diff of the report cheap."""
+    commands: list[dict[str, Any]] = []
+    for k in range(draws):
+        x = k % 200
+        commands.append(
+            {
+                'command': 'DrawRect',
+                'visible': True,
+                'coords': [x, x, x + 50, x + 50],
+                'paint': {'color': [255, k % 256, 0, 0]},
+            }
+        )
+    for k in range(layers):
+        commands.append(
+            {'command': 'SaveLayer', 'visible': True, 'paint': {'color': [128, 0, 0, 0]}}
+        )
+        commands.append(
+            {
+                'command': 'DrawRect',
+                'visible': True,
+                'coords': [k % 200, 0, k % 200 + 10, 10],
+                'paint': {'color': [128, 0, 0, 255]},
+            }
+        )
+    commands.extend({'command': 'Restore', 'visible': True} for _ in range(layers))
+    return {'version': 1, 'commands': commands}
+
+
+def check_deep(draws: int, layers: int, engine: str) -> list[str]:
+    """Runs a deep capture through the whole report pipeline, at the default
+    recursion limit, and returns what went wrong"""
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        benchmark = root / f'deep__{draws}_draws_{layers}_layers.json'
+        benchmark.write_text(json.dumps(deep_capture(draws, layers)))
+
+        output = root / 'report'
+        output.mkdir()
+        (output / EGG).mkdir()
+        (output / JSON).mkdir()
+        # Every other setting as mk_report defaults it
+        args = arg_parser().parse_args(
+            [str(root), 'rsrc', str(output), '--engine', engine], namespace=Args()
+        )
+        data = run_pipeline(args, benchmark)
+
+        problems: list[str] = []
+        for key in (
+            'compile_error',
+            'egglog_error',
+            'pre_png_err',
+            'post_png_err',
+            'pre_skp_err',
+            'post_skp_err',
+        ):
+            if key in data:
+                problems.append(f'{key}: ' + (output / data[key]).read_text().strip())
+        if data['state'] != 2 and not problems:
+            problems.append(f'stopped in state {data["state"]}')
+        if data.get('png_diff_metric'):
+            problems.append(f'renderings differ in {data["png_diff_metric"]} pixels')
+        return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='check that the report pipeline handles very deep terms'
+    )
+    parser.add_argument('--draws', type=int, default=5000)
+    parser.add_argument('--layers', type=int, default=500)
+    parser.add_argument(
+        '--engine', choices=['egglog', 'peephole', 'peephole+egglog'], default='egglog'
+    )
+    args = parser.parse_args()
+
+    problems = check_deep(args.draws, args.layers, args.engine)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if not problems:
+        print(
+            f'{args.draws} draws and {args.layers} nested layers at recursion limit '
+            f'{sys.getrecursionlimit()}: ok'
+        )
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+from dataclasses import asdict
+from functools import cache
+from pathlib import Path
+from typing import Optional
+
+from egglog_runner import EGGLOG, EGGLOG_CHECKOUT, EXTRACTION, PRELUDE, EgglogResult
+
+
+@cache
+def egglog_revision() -> bytes:
+    """What identifies the egglog build: the commit it was built from, or the
+    binary itself if it is not a git checkout"""
+    # Without a .git of its own, git would find the enclosing repository
+    if (EGGLOG_CHECKOUT / '.git').exists():
+        try:
+            return subprocess.run(
+                ['git', '-C', str(EGGLOG_CHECKOUT), 'rev-parse', 'HEAD'],
+                capture_output=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    try:
+        with EGGLOG.open('rb') as f:
+            return hashlib.file_digest(f, 'sha256').digest()
+    except OSError:
+        return b''
+
+
+class EgglogCache:
+    """On-disk cache of egglog results. Entries are keyed by a hash of the
+    program together with the prelude and extraction files it runs with and
+    the egglog build, so editing the rewrite rules or updating egglog
+    invalidates everything while changes to the renderer or the report do
+    not. Once the cache grows past `max_bytes` the least recently used
+    entries are evicted."""
+
+    def __init__(
+        self, root: Path, max_bytes: int, prelude: Path = PRELUDE, extraction: Path = EXTRACTION
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        rules = hashlib.sha256()
+        rules.update(prelude.read_bytes())
+        rules.update(b'\0')
+        rules.update(extraction.read_bytes())
+        rules.update(b'\0')
+        rules.update(egglog_revision())
+        self.rules_hash = rules.digest()
+
+    def key(self, program: str | Path, salt: str = '') -> str:
+        """`salt` tells apart results of the same program that were optimized
+        in different ways"""
+        h = hashlib.sha256(self.rules_hash)
+        if salt:
+            h.update(salt.encode() + b'\0')
+        if isinstance(program, Path):
+            with program.open('rb') as f:
+                for block in iter(lambda: f.read(1 << 16), b''):
+                    h.update(block)
+        else:
+            h.update(program.encode())
+        return h.hexdigest()
+
+    def entry(self, key: str) -> Path:
+        return self.root / (key + '.json')
+
+    def get(self, key: str) -> Optional[EgglogResult]:
+        entry = self.entry(key)
+        try:
+            result = EgglogResult(**json.loads(entry.read_text()))
+            # mtime doubles as the last-used time for eviction
+            os.utime(entry)
+        except (OSError, ValueError, TypeError):
+            return None
+        return result
+
+    def put(self, key: str, result: EgglogResult):
+        # Write to a temporary file and rename it, so that concurrent
+        # benchmarks never read a half written entry
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(asdict(result), f)
+        os.replace(tmp, self.entry(key))
+        self.evict()
+
+    def evict(self):
+        entries: list[tuple[float, int, Path]] = []
+        total = 0
+        for entry in self.root.glob('*.json'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            total -= size
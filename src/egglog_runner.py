@@ -1,21 +1,502 @@
+import re
+import shutil
 import subprocess
+import threading
+import time
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, Optional
 
+from subproc import CappedBuffer, Limits, apply_limits, classify, kill_group
 
-def run_cmd(cmd, **kwargs) -> tuple[int, str, str]:
+PRELUDE = Path('./egg-files/lambda_skia.egg')
+EXTRACTION = Path('./egg-files/extract.egg')
+# Built by `cargo build --manifest-path egglog/Cargo.toml`, see nightly.sh
+EGGLOG_CHECKOUT = Path('./egglog')
+EGGLOG = EGGLOG_CHECKOUT / 'target/debug/egglog'
+
+# Extracting a string literal just echoes it back, which lets us find the end
+# of a program's output on the worker's stdout.
+DONE = '"easteregg-done"'
+# Likewise separates the extracted term from the statistics printed after it
+STATS_MARKER = '"easteregg-stats"'
+# And the extracted terms of a batch from one another
+NEXT_MARKER = '"easteregg-next"'
+# stderr is read on a thread of its own, so it can lag behind stdout. Calling
+# an undefined function makes egglog print an error naming it, and one
+# numbered call after each program marks where the program's errors end.
+STDERR_MARKER = 'easteregg_stderr_'
+# How long to wait for that error before deciding this egglog does not name
+# the function, and taking stderr as it is
+STDERR_GRACE = 10.0
+# What extract.egg ends with, dropped when it extracts a batch instead
+EXTRACT_TEST = '(extract test)'
+# Per-rule and per-ruleset timings of the runs so far, and the number of rows
+# (e-nodes) in each function of the e-graph
+STATS = '(print-stats)\n(print-size)'
+
+# `Rule <rule>: search 0.001s, apply 0.000s, num matches 3`, or with `search
+# and apply 0.001s` in newer egglogs, and the same with `Ruleset <name>` for
+# totals, which also report merging and rebuilding
+RULE_STATS = re.compile(
+    r'^(Rule|Ruleset) (.+?): search(?: and apply)? ([\d.]+)s(?:, apply ([\d.]+)s)?'
+    r'(?:, merge ([\d.]+)s)?(?:, rebuild ([\d.]+)s)?(?:, num matches (\d+))?',
+    re.MULTILINE,
+)
+# `Function <name> has size 12`, just `<name>: 12`, or `(<name> 12)` in the
+# list newer egglogs print
+FUNCTION_SIZE = re.compile(
+    r'^(?:Function (\S+) has size |(\w+): |[ (]\((\w+) )(\d+)\)*$', re.MULTILINE
+)
+
+
+@dataclass
+class EgglogResult:
+    ret_code: int
+    output: str  # the extracted term
+    stderr: str
+    elapsed: float  # wall clock seconds spent in egglog
+    stats: Optional[dict[str, Any]] = None  # see parse_stats
+    budget: Optional[str] = None  # the Budget field that stopped the run early
+    killed_by: Optional[str] = None  # 'timeout' or 'oom', see subproc.classify
+
+
+@dataclass(frozen=True)
+class Stage:
+    """Runs `ruleset` until it saturates, or for at most `iterations`"""
+
+    ruleset: str
+    iterations: Optional[int] = None
+
+
+# The steps of a run-schedule that run_staged can run: `(saturate (run <ruleset>))`
+# or `(repeat <n> (run <ruleset>))`
+SCHEDULE_STEP = re.compile(r'\((?:saturate|repeat (\d+)) \(run (\w+)\)\)')
+
+
+def extraction_schedule(extraction: str) -> tuple[Stage, ...]:
+    """The stages of the run-schedule in extract.egg, so that a staged run
+    without a schedule of its own runs what extract.egg runs"""
+    code = re.sub(r';.*', '', extraction).replace(EXTRACT_TEST, '')
+    steps = SCHEDULE_STEP.findall(code)
+    rest = SCHEDULE_STEP.sub('', code).replace('run-schedule', '')
+    if not steps or not re.fullmatch(r'[()\s]*', rest):
+        raise ValueError(f'cannot run the schedule of {EXTRACTION} in stages')
+    return tuple(Stage(ruleset, int(n) if n else None) for n, ruleset in steps)
+
+
+def parse_schedule(spec: str) -> tuple[Stage, ...]:
+    """Parses stages separated by commas, each a ruleset optionally followed by
+    an iteration bound, e.g. `simp,opt:50`"""
+    stages: list[Stage] = []
+    for part in spec.split(','):
+        ruleset, _, iterations = part.strip().partition(':')
+        stages.append(Stage(ruleset, int(iterations) if iterations else None))
+    return tuple(stages)
+
+
+@dataclass(frozen=True)
+class Budget:
+    """Limits on a single egglog run, None being unlimited. `iterations`
+    counts over all stages of the schedule. The limits are checked every
+    `chunk` iterations, so a run overshoots them by at most that much; when
+    one trips, the best term found so far is extracted."""
+
+    iterations: Optional[int] = None
+    enodes: Optional[int] = None
+    seconds: Optional[float] = None
+    chunk: int = 4
+
+
+def parse_stats(text: str) -> dict[str, Any]:
+    """Picks the run report and e-graph size out of what egglog printed for
+    STATS. Rule timings are in seconds; where egglog times searching and
+    applying together, it all counts as search. e-nodes is the total number
+    of rows over all functions. Whatever egglog did not print is left out."""
+    rules: dict[str, dict[str, float]] = {}
+    rulesets: dict[str, dict[str, float]] = {}
+    # Summed here, as rule names are cut short and may collide
+    total_matches = 0
+    for kind, name, search, apply, merge, rebuild, matches in RULE_STATS.findall(text):
+        stats = {'search': float(search), 'apply': float(apply or 0.0)}
+        if merge:
+            stats['merge'] = float(merge)
+        if rebuild:
+            stats['rebuild'] = float(rebuild)
+        if matches:
+            stats['matches'] = int(matches)
+            if kind == 'Rule':
+                total_matches += int(matches)
+        (rules if kind == 'Rule' else rulesets)[name] = stats
+
+    sizes = {
+        long or short or listed: int(size)
+        for long, short, listed, size in FUNCTION_SIZE.findall(text)
+    }
+
+    result: dict[str, Any] = {}
+    if rules:
+        result['rules'] = rules
+        result['matches'] = total_matches
+    if rulesets:
+        result['rulesets'] = rulesets
+    if sizes:
+        result['sizes'] = sizes
+        result['enodes'] = sum(sizes.values())
+    return result
+
+
+class StartError(RuntimeError):
+    """A worker that failed to load its prelude. `killed_by` is 'oom' if it
+    ran out of memory doing so, see subproc.classify."""
+
+    def __init__(self, message: str, killed_by: Optional[str]):
+        super().__init__(message)
+        self.killed_by = killed_by
+
+
+def start_failed(e: OSError | RuntimeError) -> EgglogResult:
+    """The result of a program that never ran, as the worker for it did not
+    start"""
+    killed_by = e.killed_by if isinstance(e, StartError) else None
+    return EgglogResult(-1, '', str(e), 0.0, killed_by=killed_by)
+
+
+class EgglogWorker:
+    """A long-lived egglog REPL. The prelude and rulesets are parsed and
+    typechecked once, and every program is then run between a (push) and a
+    (pop), so that it starts from a fresh e-graph.
+
+    `limits.timeout` applies to each program, and a program that runs past it
+    gets the worker killed. `limits.memory` caps the worker as a whole; there
+    is no CPU limit, as the CPU time of a worker adds up over all programs."""
+
+    def __init__(
+        self,
+        binary: Path = EGGLOG,
+        prelude: Path = PRELUDE,
+        extraction: Path = EXTRACTION,
+        limits: Limits = Limits(),
+    ):
+        self.extraction = extraction.read_text()
+        self.limits = limits
+        self.proc = subprocess.Popen(
+            [str(binary)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            start_new_session=True,
+        )
+        apply_limits(self.proc.pid, Limits(memory=limits.memory))
+        # Set while a program runs, see _send
+        self.deadline: Optional[float] = None
+        self.timed_out = False
+
+        # stderr is drained on a separate thread so that a chatty program can
+        # never block egglog on a full pipe
+        self.stderr = CappedBuffer(limits.output, STDERR_MARKER)
+        self.exchanges = 0
+        self.marked = True
+        self.stderr_thread = threading.Thread(
+            target=self.stderr.drain, args=(self.proc.stderr,), daemon=True
+        )
+        self.stderr_thread.start()
+
+        ret_code, _, stderr = self._send(prelude)
+        if ret_code != 0:
+            self.close()
+            raise StartError(
+                f'egglog failed to load {prelude}:\n{stderr}',
+                classify(self.proc.returncode, stderr, self.timed_out),
+            )
+
+    def _take_stderr(self) -> str:
+        """What egglog wrote to stderr for the current exchange. The marker
+        sent after it is waited for first, so that no error is left for the
+        next one."""
+        if self.marked and not self.stderr.wait_mark(self.exchanges, STDERR_GRACE):
+            self.marked = False
+        return self.stderr.take()
+
+    def kill(self):
+        self.timed_out = True
+        kill_group(self.proc)
+
+    def _send(self, *chunks: str | Path) -> tuple[int, str, str]:
+        """Sends egglog to the REPL and reads stdout up to the done marker.
+        Files are streamed in rather than read into memory first. Past the
+        deadline, the worker is killed."""
+        timer = None
+        if self.deadline is not None:
+            timer = threading.Timer(max(self.deadline - time.monotonic(), 0.0), self.kill)
+            timer.start()
+        try:
+            return self._exchange(chunks)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def _exchange(self, chunks: tuple[str | Path, ...]) -> tuple[int, str, str]:
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, Path):
+                    with chunk.open() as f:
+                        shutil.copyfileobj(f, self.proc.stdin)
+                else:
+                    self.proc.stdin.write(chunk)
+                self.proc.stdin.write('\n')
+            self.exchanges += 1
+            if self.marked:
+                self.proc.stdin.write(f'({STDERR_MARKER}{self.exchanges})\n')
+            self.proc.stdin.write('(extract ' + DONE + ')\n')
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            return self.proc.wait(), '', self._take_stderr()
+
+        lines: list[str] = []
+        while True:
+            line = self.proc.stdout.readline()
+            if line == '':
+                # egglog died, the exit code is the best error we have
+                self.stderr_thread.join()
+                return self.proc.wait() or -1, ''.join(lines), self._take_stderr()
+            if line.strip() == DONE:
+                return 0, ''.join(lines), self._take_stderr()
+            lines.append(line)
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def run(
+        self,
+        program: str | Path,
+        schedule: Optional[tuple[Stage, ...]] = None,
+        budget: Optional[Budget] = None,
+    ) -> EgglogResult:
+        """Runs a program (usually a single `(let test ...)`), given as a string
+        or a file, followed by the extraction commands in a fresh e-graph.
+        With a schedule or a budget, the rulesets are run stage by stage
+        rather than as extract.egg runs them, see run_staged. If egglog ran
+        out of time or memory, the result says which."""
+        if self.limits.timeout is not None:
+            self.deadline = time.monotonic() + self.limits.timeout
+        try:
+            if schedule is not None or budget is not None:
+                try:
+                    schedule = schedule or extraction_schedule(self.extraction)
+                except ValueError as e:
+                    return EgglogResult(1, '', str(e), 0.0)
+                result = self.run_staged(program, schedule, budget or Budget())
+            else:
+                start = time.perf_counter()
+                ret_code, output, stderr = self._send(
+                    '(push)',
+                    program,
+                    self.extraction,
+                    '(extract ' + STATS_MARKER + ')',
+                    STATS,
+                    '(pop)',
+                )
+                result = self._result(start, ret_code, output, stderr)
+        finally:
+            self.deadline = None
+
+        if result.ret_code != 0 and not self.alive():
+            result.killed_by = classify(self.proc.wait(), result.stderr, self.timed_out)
+        return result
+
+    def run_staged(
+        self, program: str | Path, schedule: tuple[Stage, ...], budget: Budget
+    ) -> EgglogResult:
+        """Runs the stages of a schedule in order, a chunk of iterations at a
+        time, checking the budget after each chunk. The REPL does not print
+        whether a run changed the e-graph, but its statistics count the
+        matches of every rule so far. A chunk in which no rule matched changed
+        nothing, so the ruleset has saturated; the e-graph size is no guide,
+        as merging e-classes need not add rows. egglog stops a run at the
+        first iteration that changes nothing, so the iterations counted are
+        an upper bound. A stage still matching when the iteration budget runs
+        out is run one iteration further between a push and a pop, and only
+        counts as cut short if that iteration matched anything."""
+        start = time.perf_counter()
+        ret_code, output, stderr = self._send('(push)', program, STATS)
+        # Matches over all runs so far, including those of earlier programs
+        previous = parse_stats(output + stderr).get('matches', 0)
+        iterations = 0
+        tripped: Optional[str] = None
+
+        for stage in schedule:
+            if ret_code != 0 or tripped is not None:
+                break
+            done = 0
+            while stage.iterations is None or done < stage.iterations:
+                if budget.iterations is not None and iterations >= budget.iterations:
+                    # The last chunk may have saturated the stage part way
+                    # through. One more iteration, undone right after, tells.
+                    ret_code, output, probe_stderr = self._send(
+                        '(push)', f'(run {stage.ruleset} 1)', STATS, '(pop)'
+                    )
+                    stderr += probe_stderr
+                    if ret_code == 0 and parse_stats(output).get('matches', 0) != previous:
+                        tripped = 'iterations'
+                    if ret_code == 0:
+                        ret_code, output, probe_stderr = self._send(STATS)
+                        stderr += probe_stderr
+                        previous = parse_stats(output).get('matches', 0)
+                    break
+
+                chunk = budget.chunk
+                if stage.iterations is not None:
+                    chunk = min(chunk, stage.iterations - done)
+                if budget.iterations is not None:
+                    chunk = min(chunk, budget.iterations - iterations)
+                ret_code, output, chunk_stderr = self._send(f'(run {stage.ruleset} {chunk})', STATS)
+                stderr += chunk_stderr
+                if ret_code != 0:
+                    break
+                done += chunk
+                iterations += chunk
+
+                stats = parse_stats(output + chunk_stderr)
+                enodes, matches = stats.get('enodes'), stats.get('matches', 0)
+                if enodes is None:
+                    ret_code = 1
+                    stderr += 'egglog printed no e-graph size, cannot enforce the budget\n'
+                    break
+                # A saturated stage is done, whatever budget the chunk used up
+                if matches == previous:
+                    break
+                previous = matches
+                if budget.enodes is not None and enodes > budget.enodes:
+                    tripped = 'enodes'
+                elif budget.seconds is not None and time.perf_counter() - start > budget.seconds:
+                    tripped = 'seconds'
+                if tripped is not None:
+                    break
+
+        if ret_code != 0:
+            if self.alive():
+                self._send('(pop)')
+            return EgglogResult(ret_code, '', stderr, time.perf_counter() - start)
+
+        ret_code, output, extract_stderr = self._send(
+            '(extract test)', '(extract ' + STATS_MARKER + ')', STATS, '(pop)'
+        )
+        result = self._result(start, ret_code, output, stderr + extract_stderr)
+        result.budget = tripped
+        if result.stats is not None:
+            result.stats['iterations'] = iterations
+        return result
+
+    def run_batch(self, terms: list[str]) -> list[EgglogResult]:
+        """Runs several terms, given as sexps, in a single e-graph as `test_0`,
+        `test_1` and so on, and extracts each. This saves the round trips and
+        per-program overheads that dominate for small terms. Sharing the
+        e-graph is sound, as rewrites only ever merge equal e-classes.
+
+        Each result is given an equal share of the elapsed time. A term that
+        fails to extract gets a failed result; egglog's errors cannot be told
+        apart per term, so it gets all of them."""
+        assert EXTRACT_TEST in self.extraction, f'{EXTRACTION} does not end in {EXTRACT_TEST}'
+        lets = ''.join(f'(let test_{k} {term})\n' for k, term in enumerate(terms))
+        extracts = [
+            command
+            for k in range(len(terms))
+            for command in ('(extract ' + NEXT_MARKER + ')', f'(extract test_{k})')
+        ]
+
+        if self.limits.timeout is not None:
+            self.deadline = time.monotonic() + self.limits.timeout
+        try:
+            start = time.perf_counter()
+            ret_code, output, stderr = self._send(
+                '(push)', lets, self.extraction.replace(EXTRACT_TEST, ''), *extracts, '(pop)'
+            )
+            elapsed = (time.perf_counter() - start) / max(len(terms), 1)
+        finally:
+            self.deadline = None
+
+        killed_by = None
+        if ret_code != 0 and not self.alive():
+            killed_by = classify(self.proc.wait(), stderr, self.timed_out)
+        # Whatever came before the first marker is not a term
+        outputs = output.split(NEXT_MARKER + '\n')[1:]
+        outputs += [''] * (len(terms) - len(outputs))
+
+        results: list[EgglogResult] = []
+        for term_output in outputs:
+            if ret_code == 0 and term_output.strip() != '':
+                results.append(EgglogResult(0, term_output, '', elapsed))
+            else:
+                results.append(
+                    EgglogResult(ret_code or 1, '', stderr, elapsed, killed_by=killed_by)
+                )
+        return results
+
+    def _result(self, start: float, ret_code: int, output: str, stderr: str) -> EgglogResult:
+        elapsed = time.perf_counter() - start
+        output, _, stats = output.partition(STATS_MARKER + '\n')
+
+        # The REPL reports errors and carries on, so a failed program shows up
+        # as nothing having been extracted
+        if ret_code == 0 and output.strip() == '':
+            ret_code = 1
+
+        return EgglogResult(ret_code, output, stderr, elapsed, parse_stats(stats + stderr))
+
+    def close(self):
+        if self.proc.stdin is not None:
+            self.proc.stdin.close()
+        self.proc.wait()
+
+
+_worker: Optional[EgglogWorker] = None
+
+
+def live_worker(limits: Limits) -> EgglogWorker:
+    """This process's egglog worker, starting (or restarting, if the
+    previous one died or has other limits) it as needed"""
+    global _worker
+    if _worker is not None and _worker.alive() and _worker.limits != limits:
+        _worker.close()
+    if _worker is None or not _worker.alive():
+        _worker = None
+        _worker = EgglogWorker(limits=limits)
+    return _worker
+
+
+def close_worker():
+    """Closes this process's egglog worker, if it has one, and waits for it.
+    A child's peak memory only counts towards RUSAGE_CHILDREN once it has
+    been waited for."""
+    global _worker
+    if _worker is not None:
+        _worker.close()
+        _worker = None
+
+
+def run_egglog_program(
+    program: str | Path,
+    schedule: Optional[tuple[Stage, ...]] = None,
+    budget: Optional[Budget] = None,
+    limits: Limits = Limits(),
+) -> EgglogResult:
+    """Runs a program on this process's egglog worker"""
+    try:
+        worker = live_worker(limits)
+    except (OSError, RuntimeError) as e:
+        return start_failed(e)
+    return worker.run(program, schedule, budget)
+
+
+def run_egglog_batch(terms: list[str], limits: Limits = Limits()) -> list[EgglogResult]:
+    """Runs a batch of terms on this process's egglog worker, see
+    EgglogWorker.run_batch"""
     try:
-        # Copy the current environment
-        # my_env = os.environ.copy()
-        # for key in kwargs.keys():
-        #     my_env[key] = kwargs[key]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        return result.returncode, result.stdout, result.stderr
-    except Exception as e:
-        return -1, '', str(e)
-
-
-def run_egglog(egg_file):
-    prelude = Path('./egg-files/lambda_skia.egg')
-    extraction = Path('./egg-files/extract.egg')
-    command = f'cargo run --quiet --manifest-path ./egglog/Cargo.toml -- {prelude} {egg_file} {extraction}'
-    return run_cmd(command.split(), RUST_LOG='error')
+        worker = live_worker(limits)
+    except (OSError, RuntimeError) as e:
+        return [start_failed(e) for _ in terms]
+    return worker.run_batch(terms)
@@ -0,0 +1,143 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+
+@dataclass(frozen=True)
+class Metric:
+    """A per-benchmark number tracked across runs, where higher is worse.
+    Counts regress as soon as they exceed the best of the previous runs; noisy
+    measurements only once they exceed the median of the previous runs by
+    `threshold` (relative) and by at least `min_delta`."""
+
+    extract: Callable[[dict[str, Any]], Optional[float]]
+    noisy: bool
+    min_delta: float = 0.0
+
+
+def render_ms(row: dict[str, Any]) -> Optional[float]:
+    timings = row.get('timings', {})
+    if 'png' not in timings:
+        return None
+    return timings['png'] + timings.get('skp', 0.0)
+
+
+METRICS: dict[str, Metric] = {
+    # SaveLayers left after optimization
+    'savelayers': Metric(lambda row: row['counts'][1] if 'counts' in row else None, noisy=False),
+    # Cached egglog results carry the time of the run that produced them, and
+    # batched ones a share of the time of their batch
+    'egglog_time': Metric(
+        lambda row: (
+            None
+            if row.get('egglog_cached') or row.get('egglog_batched')
+            else row.get('egglog_time')
+        ),
+        noisy=True,
+        min_delta=0.05,
+    ),
+    'render_ms': Metric(render_ms, noisy=True, min_delta=50.0),
+    # Size of the saturated e-graph
+    'enodes': Metric(lambda row: row.get('egglog_stats', {}).get('enodes'), noisy=True),
+}
+
+
+def git_commit() -> str:
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else 'unknown'
+
+
+def record_run(report: Path, history: Path, commit: str, date: str):
+    """Appends the metrics of one report.json to the history, one JSON line
+    per run"""
+    with report.open() as f:
+        content = json.load(f)
+
+    benchmarks: dict[str, dict[str, Any]] = {}
+    for row in content['results']:
+        metrics = {name: metric.extract(row) for name, metric in METRICS.items()}
+        metrics['state'] = row['state']
+        benchmarks[row['name']] = metrics
+
+    run = {'commit': commit, 'date': date, 'benchmarks': benchmarks}
+    with history.open('a') as f:
+        f.write(json.dumps(run) + '\n')
+
+
+def read_runs(history: Path) -> list[dict[str, Any]]:
+    with history.open() as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(runs: list[dict[str, Any]], last: int, threshold: float) -> list[str]:
+    """Compares the latest run against the `last` runs before it"""
+    if len(runs) < 2:
+        return []
+    latest, previous = runs[-1], runs[-1 - last : -1]
+
+    regressions: list[str] = []
+    for name, metrics in sorted(latest['benchmarks'].items()):
+        for metric_name, metric in METRICS.items():
+            value = metrics.get(metric_name)
+            history = [
+                run['benchmarks'][name][metric_name]
+                for run in previous
+                if run['benchmarks'].get(name, {}).get(metric_name) is not None
+            ]
+            if value is None or not history:
+                continue
+
+            if metric.noisy:
+                baseline = statistics.median(history)
+                regressed = value - baseline > max(threshold * baseline, metric.min_delta)
+            else:
+                baseline = min(history)
+                regressed = value > baseline
+            if regressed:
+                regressions.append(f'{name}: {metric_name} {baseline:g} -> {value:g}')
+
+        # A benchmark that used to make it through the pipeline and no longer does
+        states = [run['benchmarks'][name]['state'] for run in previous if name in run['benchmarks']]
+        if states and metrics['state'] < max(states):
+            regressions.append(f'{name}: state {max(states)} -> {metrics["state"]}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='track benchmark results across runs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record = subparsers.add_parser('record', help='append a report.json to the history')
+    record.add_argument('report', type=Path)
+    record.add_argument('history', type=Path)
+    record.add_argument('--commit', default=None, help='defaults to the checked out commit')
+
+    compare = subparsers.add_parser('compare', help='flag regressions in the latest run')
+    compare.add_argument('history', type=Path)
+    compare.add_argument('--last', type=int, default=5, help='number of runs to compare against')
+    compare.add_argument(
+        '--threshold', type=float, default=0.25, help='relative slowdown that counts as one'
+    )
+    compare.add_argument('--strict', action='store_true', help='exit with 1 on any regression')
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        date = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        record_run(args.report, args.history, args.commit or git_commit(), date)
+    else:
+        runs = read_runs(args.history)
+        regressions = find_regressions(runs, args.last, args.threshold)
+        if runs:
+            earlier = min(args.last, len(runs) - 1)
+            print(f'{runs[-1]["commit"]} ({runs[-1]["date"]}) against {earlier} earlier runs')
+        for regression in regressions:
+            print(regression)
+        if args.strict and regressions:
+            sys.exit(1)
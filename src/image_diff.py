@@ -0,0 +1,49 @@
+import math
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import skia  # pyrefly: ignore
+
+
+@dataclass(frozen=True)
+class ImageDiff:
+    """How far apart two renderings are. `ae` is the number of pixels that
+    differ in any channel, `rmse` the root mean squared error over all
+    channels normalized to [0, 1], and `psnr` the peak signal to noise ratio in
+    dB (infinite for identical images)."""
+
+    ae: int
+    rmse: float
+    psnr: float
+
+
+def diff_pixels(pre: np.ndarray, post: np.ndarray) -> ImageDiff:
+    """Compares two HxWx4 uint8 pixel buffers of the same size."""
+    assert pre.shape == post.shape, f'cant diff {pre.shape} against {post.shape}'
+
+    delta = pre.astype(np.int16) - post.astype(np.int16)
+    ae = int(np.count_nonzero(delta.any(axis=-1)))
+    if ae == 0:
+        return ImageDiff(0, 0.0, math.inf)
+
+    rmse = math.sqrt(np.mean(np.square(delta, dtype=np.int32))) / 255
+    return ImageDiff(ae, rmse, 20 * math.log10(1 / rmse))
+
+
+def write_diff_png(pre: np.ndarray, post: np.ndarray, output: Path):
+    """Writes a heatmap of where two pixel buffers differ: the pre image faded
+    out, with every differing pixel in red, brighter the larger the
+    difference."""
+    delta = np.abs(pre.astype(np.int16) - post.astype(np.int16)).max(axis=-1)
+
+    heatmap = np.empty_like(pre)
+    heatmap[..., :3] = 170 + pre[..., :3] // 3
+    heatmap[..., 3] = 255
+
+    differs = delta > 0
+    heatmap[differs, 0] = 128 + delta[differs] // 2
+    heatmap[differs, 1:3] = 0
+
+    image = skia.Image.fromarray(heatmap, colorType=skia.ColorType.kRGBA_8888_ColorType)
+    image.save(str(output), skia.kPNG)
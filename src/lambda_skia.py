@@ -1,35 +1,133 @@
+import io
+import threading
 from dataclasses import dataclass, fields
-from typing import Any, Literal, Self, override
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Literal,
+    Optional,
+    Self,
+    Sequence,
+    TextIO,
+    override,
+)
+from weakref import WeakValueDictionary
 
 import skia  # pyrefly: ignore
 
 
-@dataclass
-class Node:
+def intern_key(value: Any) -> Any:
+    """A key for a node field that only equals the key of an identical value.
+    Field values that compare equal can still print differently, like 0.0
+    and -0.0, or 1, 1.0 and True. Floats are keyed by their exact hex form,
+    which also keeps the sign of zero."""
+    if isinstance(value, float):
+        return float, value.hex()
+    if isinstance(value, tuple):
+        return tuple(map(intern_key, value))
+    return type(value), value
+
+
+class Interned(type):
+    """Metaclass that hash-conses nodes. Constructing a node whose fields are
+    identical to those of a live node returns the live node, so structurally
+    equal terms are the same object and can be compared and hashed by
+    identity. Nodes may be built from several threads at once."""
+
+    def __init__(cls, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # One table per class, so the field keys alone can be the key
+        cls.interned: WeakValueDictionary[tuple[Any, ...], Any] = WeakValueDictionary()
+        cls.intern_lock = threading.Lock()
+
+    def __call__(cls, *args, **kwargs):
+        if kwargs:
+            node = super().__call__(*args, **kwargs)
+            key = tuple(intern_key(getattr(node, field.name)) for field in fields(node))
+            with cls.intern_lock:
+                return cls.interned.setdefault(key, node)
+
+        # Children are interned already, so hashing them is O(1)
+        key = tuple(map(intern_key, args))
+        with cls.intern_lock:
+            node = cls.interned.get(key)
+            if node is None:
+                node = super().__call__(*args)
+                cls.interned[key] = node
+        return node
+
+
+# Nodes are immutable and interned, so equality and hashing are by identity
+@dataclass(frozen=True, slots=True, eq=False, weakref_slot=True)
+class Node(metaclass=Interned):
     def sexp(self) -> str:
-        class_name = self.__class__.__name__
+        buffer = io.StringIO()
+        write_sexp(self, buffer)
+        return buffer.getvalue()
+
+    def sexp_head(self) -> str:
+        """The egglog constructor of this node"""
+        return self.__class__.__name__
+
+    def sexp_args(self) -> Iterable[Any]:
+        """The arguments of this node's egglog constructor"""
+        return [getattr(self, name) for name in self.__match_args__]
+
+
+def walk[T](root: T, expand: Callable[[T], Optional[Sequence[T]]]) -> Iterator[T]:
+    """Yields what `root` expands to, depth first and in order. `expand`
+    returns the items that stand in for an item, or None to yield the item
+    itself. Layers are chains as deep as the number of draws on a page, far
+    past the recursion limit, so every pass over a whole term goes through
+    here, with an explicit stack, rather than recursing."""
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        parts = expand(item)
+        if parts is None:
+            yield item
+        else:
+            stack.extend(reversed(parts))
+
+
+@dataclass(frozen=True, slots=True)
+class Combine[N]:
+    """Stands for a node in the walk of fold, once its children are done"""
+
+    node: N
+
 
-        try:
-            field_values = [getattr(self, field.name) for field in fields(self)]
+def fold[N: Node, R](
+    root: N,
+    combine: Callable[[N, dict[N, R]], R],
+    kind: type[N],
+    memo: Optional[dict[N, R]] = None,
+) -> R:
+    """Computes combine(node, memo) for the root and every argument of type
+    `kind` under it, children first, and returns the root's. `combine` finds
+    the results for the node's arguments in `memo`. Nodes are interned, so a
+    subterm that occurs many times is combined once."""
+    results: dict[N, R] = {} if memo is None else memo
+    if root in results:
+        return results[root]
 
-            values: list[str] = []
-            for value in field_values:
-                match value:
-                    case Node():
-                        values.append(value.sexp())
-                    case str():
-                        values.append(value)
-                    case bool():
-                        values.append('true' if value else 'false')
-                    case _:
-                        values.append(str(value))
+    def expand(item: N | Combine[N]) -> list[N | Combine[N]]:
+        if isinstance(item, Combine):
+            results[item.node] = combine(item.node, results)
+            return []
+        if item in results:
+            return []
+        pending = [arg for arg in item.sexp_args() if isinstance(arg, kind) and arg not in results]
+        return [*pending, Combine(item)]
 
-            return f'({class_name} {" ".join(values)})' if values else f'({class_name})'
-        except TypeError:
-            raise NotImplementedError()
+    for _ in walk(root, expand):
+        pass
+    return results[root]
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Color(Node):
     """A solid color defined by alpha, red, green, and blue channel values."""
 
@@ -42,7 +140,7 @@ class Color(Node):
         return f'Color({int(self.a * 255)}, {int(self.r * 255)}, {int(self.b * 255)}, {int(self.g * 255)})'
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class LinearGradient(Node):
     """Linear gradient shader"""
 
@@ -52,7 +150,7 @@ class LinearGradient(Node):
         return 'LinearGradient'
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class RadialGradient(Node):
     """Radial gradient shader"""
 
@@ -62,18 +160,22 @@ class RadialGradient(Node):
         return 'RadialGradient'
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Transform(Node):
     """4x4 transform matrix"""
 
-    matrix: list[float]
+    matrix: tuple[float, ...]
 
     @override
-    def sexp(self) -> str:
-        return '(Matrix ' + ' '.join([str(i) for i in self.matrix]) + ')'
+    def sexp_head(self) -> str:
+        return 'Matrix'
+
+    @override
+    def sexp_args(self) -> Iterable[Any]:
+        return self.matrix
 
     def pprint(self) -> str:
-        return 'Mat' + str(self.matrix)
+        return 'Mat' + str(list(self.matrix))
 
 
 def mk_color(argb: list[int]):
@@ -89,13 +191,13 @@ type Style = Literal['(Solid)', '(Stroke)']
 type Filter = Literal['(IdFilter)', '(LumaFilter)']
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Geometry(Node):
     def pprint(self) -> str:
         raise NotImplementedError()
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Full(Geometry):
     """A geometry representing the full clip. Used in conjunction with
     DrawPaint"""
@@ -105,7 +207,7 @@ class Full(Geometry):
         return 'Full()'
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Rect(Geometry):
     """A rectangular geometry defined by left, top, right, and bottom
     coordinates."""
@@ -120,7 +222,7 @@ class Rect(Geometry):
         return f'Rect({self.l}, {self.t}, {self.r}, {self.b})'
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class TextBlob(Geometry):
     """A textblob geometry defined by text, position, and attributes"""
 
@@ -136,7 +238,7 @@ class TextBlob(Geometry):
         return f'TextBlob({self.x}, {self.y}, {self.l}, {self.t}, {self.r}, {self.b})'
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class ImageRect(Geometry):
     l: float
     t: float
@@ -148,7 +250,7 @@ class ImageRect(Geometry):
         return f'ImageRect({self.l}, {self.t}, {self.r}, {self.b})'
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class RRect(Geometry):
     """An elliptical rounded rectangular geometry defined by left, top, right,
     and bottom coordinates, and the radii."""
@@ -212,7 +314,7 @@ class RRect(Geometry):
         )
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Oval(Geometry):
     """A rectangular geometry defined by left, top, right, and bottom
     coordinates."""
@@ -227,7 +329,7 @@ class Oval(Geometry):
         return f'Oval({self.l}, {self.t}, {self.r}, {self.b})'
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Path(Geometry):
     """A geometry that defines an arbitrary closed or open path"""
 
@@ -287,7 +389,7 @@ class Path(Geometry):
         return path
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Intersect(Geometry):
     """A geometry that represents the intersection of two or more geometries."""
 
@@ -299,7 +401,7 @@ class Intersect(Geometry):
         return self.g1.pprint() + ' ∩ ' + self.g2.pprint()
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Difference(Geometry):
     """A geometry that represents the difference of two or more geometries."""
 
@@ -311,7 +413,7 @@ class Difference(Geometry):
         return self.g1.pprint() + ' / ' + self.g2.pprint()
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Paint(Node):
     """Configuration that determines how geometries are filled and blended when
     drawn."""
@@ -336,6 +438,7 @@ class Paint(Node):
         )
 
 
+@dataclass(frozen=True, slots=True, eq=False)
 class Layer(Node):
     """A drawing surface that can contain pixels and be composited with other
     layers."""
@@ -343,21 +446,35 @@ class Layer(Node):
     def pretty_print(self, indent_level: int = 0) -> list[tuple[int, str]]:
         """Pretty-printing a layer, returns a list of tuples of an int and a
         string. Each element is a line, the string tis content and the integer
-        tells us how nested it is"""
+        tells us how nested it is."""
+
+        def expand(entry: tuple[int, Layer | str]) -> Optional[list[tuple[int, Layer | str]]]:
+            level, item = entry
+            return None if isinstance(item, str) else item.pretty_print_items(level)
+
+        return [
+            (level, line)
+            for level, line in walk((indent_level, self), expand)
+            if isinstance(line, str)
+        ]
+
+    def pretty_print_items(self, indent_level: int) -> list[tuple[int, 'Layer | str']]:
+        """The lines of this layer in order, with the layers it contains
+        standing in for their own lines"""
         raise NotImplementedError()
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Empty(Layer):
     """A layer that contains no pixels and serves as the base for all drawing
     operations."""
 
     @override
-    def pretty_print(self, indent_level=0) -> list[tuple[int, str]]:
+    def pretty_print_items(self, indent_level: int) -> list[tuple[int, Layer | str]]:
         return [(indent_level, 'Empty()')]
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class SaveLayer(Layer):
     """A layer that composites a top layer onto a bottom layer using the
     specified paint settings."""
@@ -367,44 +484,36 @@ class SaveLayer(Layer):
     paint: Paint
 
     @override
-    def pretty_print(self, indent_level: int = 0) -> list[tuple[int, str]]:
+    def pretty_print_items(self, indent_level: int) -> list[tuple[int, Layer | str]]:
         # i, self.bottom
         # i, SaveLayer self.paint
         # i + 1 self.top
-        res: list[tuple[int, str]] = []
+        res: list[tuple[int, Layer | str]] = []
         if not isinstance(self.bottom, Empty):
-            res = self.bottom.pretty_print(indent_level)
-
+            res.append((indent_level, self.bottom))
         res.append((indent_level, 'SaveLayer ' + self.paint.pprint() + ':'))
-        if isinstance(self.top, Empty):
-            res.append((indent_level + 1, 'Empty()'))
-        else:
-            res.extend(self.top.pretty_print(indent_level + 1))
+        res.append((indent_level + 1, self.top))
         return res
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Clip(Layer):
     layer: Layer
     clip: Geometry
     transform: Transform
 
     @override
-    def pretty_print(self, indent_level: int = 0) -> list[tuple[int, str]]:
+    def pretty_print_items(self, indent_level: int) -> list[tuple[int, Layer | str]]:
         # i, Clip with self.clip
         # i + 1, self.layer
+        return [
+            (indent_level, 'Clip with ' + self.clip.pprint() + ':'),
+            (indent_level + 1, '@ ' + self.transform.pprint()),
+            (indent_level + 1, self.layer),
+        ]
 
-        res: list[tuple[int, str]] = []
-        res.append((indent_level, 'Clip with ' + self.clip.pprint() + ':'))
-        res.append((indent_level + 1, '@ ' + self.transform.pprint()))
-        if isinstance(self.layer, Empty):
-            res.append((indent_level + 1, 'Empty()'))
-        else:
-            res.extend(self.layer.pretty_print(indent_level + 1))
-        return res
 
-
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Draw(Layer):
     """A layer that renders a geometry onto an existing layer with the given
     paint and clipping region."""
@@ -416,13 +525,12 @@ class Draw(Layer):
     transform: Transform
 
     @override
-    def pretty_print(self, indent_level: int = 0) -> list[tuple[int, str]]:
+    def pretty_print_items(self, indent_level: int) -> list[tuple[int, Layer | str]]:
         # i, self.bottom
         # i, Draw()
-        res: list[tuple[int, str]] = []
+        res: list[tuple[int, Layer | str]] = []
         if not isinstance(self.bottom, Empty):
-            res = self.bottom.pretty_print(indent_level)
-
+            res.append((indent_level, self.bottom))
         res.append((indent_level, 'Draw ' + self.shape.pprint()))
         res.append((indent_level + 1, 'with ' + self.paint.pprint()))
         res.append((indent_level + 1, 'in ' + self.clip.pprint()))
@@ -431,9 +539,60 @@ class Draw(Layer):
 
 
 def pretty_print_layer(layer: Layer) -> str:
-    output = layer.pretty_print()
-    res = ''
-    for i, line in output:
-        res += '  ' * i + line + '\n'
+    return ''.join('  ' * i + line + '\n' for i, line in layer.pretty_print())
+
+
+def sexp_atom(value: Any) -> str:
+    match value:
+        case str():
+            return value
+        case bool():
+            return 'true' if value else 'false'
+        case _:
+            return str(value)
+
+
+def sexp_leaf(node: Node, memo: dict[Node, str]) -> str:
+    """Sexp of a node that is not a layer. Paints and clip chains are shared by
+    many draws, so their strings are memoized in `memo`."""
+
+    def combine(top: Node, memo: dict[Node, str]) -> str:
+        parts = [memo[arg] if isinstance(arg, Node) else sexp_atom(arg) for arg in top.sexp_args()]
+        head = top.sexp_head()
+        return '(' + head + ' ' + ' '.join(parts) + ')' if parts else '(' + head + ')'
+
+    return fold(node, combine, Node, memo)
+
+
+def write_sexp(node: Node, out: TextIO) -> None:
+    """Writes the sexp of a node to `out`, a piece at a time"""
+    memo: dict[Node, str] = {}
+
+    def expand(item: Node | str) -> Optional[list[Node | str]]:
+        if isinstance(item, str):
+            return None
+        if not isinstance(item, Layer):
+            return [sexp_leaf(item, memo)]
+
+        args = list(item.sexp_args())
+        if not args:
+            return ['(' + item.sexp_head() + ')']
+        parts: list[Node | str] = ['(' + item.sexp_head()]
+        for arg in args:
+            parts.append(' ')
+            parts.append(arg if isinstance(arg, Node) else sexp_atom(arg))
+        parts.append(')')
+        return parts
+
+    out.writelines(piece for piece in walk(node, expand) if isinstance(piece, str))
+
+
+def count_save_layers(layer: Layer) -> int:
+    """Number of SaveLayers in the term, i.e. the number of times SaveLayer
+    appears in its sexp"""
+
+    def combine(node: Layer, memo: dict[Layer, int]) -> int:
+        count = sum(memo[arg] for arg in node.sexp_args() if isinstance(arg, Layer))
+        return count + 1 if isinstance(node, SaveLayer) else count
 
-    return res
+    return fold(layer, combine, Layer)
@@ -1,21 +1,40 @@
 import argparse
 import json
+import multiprocessing.util
+import resource
 import shutil
 import sys
+import time
+import tracemalloc
 import traceback
 from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from difflib import HtmlDiff
 from pathlib import Path
-from typing import Any, final
+from typing import Any, Optional, final
 
 from mako.template import Template
 
-from egglog_runner import run_cmd, run_egglog
-from lambda_skia import pretty_print_layer
+from egglog_cache import EgglogCache
+from egglog_runner import (
+    Budget,
+    EgglogResult,
+    Stage,
+    close_worker,
+    parse_schedule,
+    run_egglog_batch,
+    run_egglog_program,
+)
+from image_diff import diff_pixels, write_diff_png
+from lambda_skia import count_save_layers, pretty_print_layer, write_sexp
 from parse_sexp import parse_sexp
-from renderer import egg_to_png, egg_to_skp
+from peephole import peephole
+from renderer import egg_to_png, egg_to_skp, flatten_layer
 from skp_compiler import compile_skp_to_lskia, get_reset_warnings
-from verify import verify_skp
+from skp_loader import SkpSideTable, stream_skp
+from split_optimizer import close_workers, optimize_split
+from subproc import Limits
+from verify import Verifier
 
 EGG = 'egg'
 JSON = 'json'
@@ -33,147 +52,454 @@ def rewrite_name(string: str) -> str:
     return suite + ' | ' + name
 
 
+class StageTimer:
+    """Splits the wall clock time of a benchmark into stages. Each lap charges
+    the time since the previous one to a stage, in milliseconds."""
+
+    def __init__(self, timings: dict[str, float]):
+        self.timings = timings
+        self.last = time.perf_counter_ns()
+
+    def lap(self, stage: str):
+        now = time.perf_counter_ns()
+        self.timings[stage] = self.timings.get(stage, 0.0) + (now - self.last) / 1e6
+        self.last = now
+
+
 class Args(Namespace):
     bench: Path
     rsrc: Path
     output: Path
+    jobs: int
+    cache: Optional[Path]
+    cache_size: int
+    trace_memory: bool
+    engine: str
+    split: bool
+    split_jobs: int
+    schedule: Optional[str]
+    max_iterations: Optional[int]
+    max_enodes: Optional[int]
+    max_seconds: Optional[float]
+    timeout: Optional[float]
+    memory_limit: Optional[int]
+    batch_below: Optional[int]
+
+
+def egglog_settings(args: Args) -> tuple[Optional[tuple[Stage, ...]], Optional[Budget], Limits]:
+    """The schedule, budget and limits egglog runs with"""
+    schedule = parse_schedule(args.schedule) if args.schedule else None
+    budget = None
+    if (args.max_iterations, args.max_enodes, args.max_seconds) != (None, None, None):
+        budget = Budget(args.max_iterations, args.max_enodes, args.max_seconds)
+    memory = args.memory_limit * 2**20 if args.memory_limit else None
+    return schedule, budget, Limits(timeout=args.timeout, memory=memory)
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """Peak resident set size in MiB. getrusage reports it in bytes on macOS
+    and in KiB elsewhere."""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def close_egglog():
+    """Closes every egglog worker of this process and waits for them, so that
+    their memory shows in RUSAGE_CHILDREN"""
+    close_worker()
+    close_workers()
+
+
+def close_egglog_at_exit():
+    """Pool initializer. Pool processes exit without running atexit hooks,
+    but do run multiprocessing's finalizers."""
+    multiprocessing.util.Finalize(None, close_egglog, exitpriority=0)
+
+
+def run_benchmark(
+    args: Args, benchmark: Path, batched: Optional[EgglogResult] = None
+) -> dict[str, Any]:
+    """Runs the whole pipeline on a single benchmark and returns its report row.
+    Each call is independent of the others, so benchmarks can be run on a
+    process pool. The row records how long each stage took and, with
+    --trace-memory, how much memory was used. `batched` is what batch_egglog
+    got for it, if anything."""
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter_ns()
+
+    data = run_pipeline(args, benchmark, batched)
+
+    data['timings']['total'] = (time.perf_counter_ns() - start) / 1e6
+    if args.trace_memory:
+        # The high-water mark of the process, which is this benchmark's own as
+        # collate_data gives each benchmark a fresh one, or of its egglog
+        # workers. The process exits after this, so they are closed now.
+        close_egglog()
+        data['peak_rss_mb'] = max(peak_rss_mb(), peak_rss_mb(resource.RUSAGE_CHILDREN))
+        data['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return data
+
+
+def run_pipeline(
+    args: Args, benchmark: Path, batched: Optional[EgglogResult] = None
+) -> dict[str, Any]:
 
-
-def collate_data(args: Args):
     def htmlify_path(path: Path):
         return './' + str(path.relative_to(args.output))
 
     EGG_FOLDER: Path = args.output / EGG
     JSON_FOLDER: Path = args.output / JSON
 
-    results = []
-    improved = 0
-    unchanged = 0
-    regressed = 0
-    failed = 0
-    # Track the aggregate number of SaveLayer nodes across successful benchmarks so the
-    # summary view can surface total before/after counts alongside per-benchmark data.
-    savelayer_before_total = 0
-    savelayer_after_total = 0
-    savelayer_successes = 0
+    data: dict[str, Any] = dict()
+    data['state'] = 2
+    timer = StageTimer(data.setdefault('timings', {}))
 
-    benchmarks: list[Path] = list(args.bench.glob('*.json'))
+    name = benchmark.stem
+    data['name'] = name
 
-    for i, benchmark in enumerate(benchmarks):
-        print(f'[{i + 1}/{len(benchmarks)}] running ' + str(benchmark))
+    full_name = rewrite_name(name)
+    data['full_name'] = full_name
 
-        data: dict[str, Any] = dict()
-        data['state'] = 2
+    suite, _ = name.split('__', 1)
+    data['website'] = suite.replace('_', '-'.lower())
 
-        name = benchmark.stem
-        data['name'] = name
+    # 1. the JSON skp is streamed by each pass below, never loaded whole.
+    # Compiling fills in a side table of what rendering needs from it.
 
-        full_name = rewrite_name(name)
-        data['full_name'] = full_name
+    shutil.copy(benchmark, JSON_FOLDER / benchmark.name)
+    data['json_skp'] = htmlify_path(JSON_FOLDER / benchmark.name)
 
-        suite, _ = name.split('__', 1)
-        data['website'] = suite.replace('_', '-'.lower())
+    skp_table = SkpSideTable()
+    timer.lap('load')
 
-        # 1. read JSON skp
+    # 2. verify the JSON skp conforms to our skia subset. This happens as the
+    # commands stream into the compiler, so they are only read once
+    verifier = Verifier(stream_skp(benchmark, skp_table))
 
-        with benchmark.open('rb') as f:
-            json_skp = json.load(f)
-
-        shutil.copy(benchmark, JSON_FOLDER / benchmark.name)
-        data['json_skp'] = htmlify_path(JSON_FOLDER / benchmark.name)
-
-        data['number_cmds'] = len(json_skp['commands'])
-
-        # 2. verify the JSON skp conforms to our skia subset
-        try:
-            verify_skp(json_skp)
-        except Exception:
-            tb = traceback.format_exc()
+    def record_verify_error():
+        if verifier.error is not None:
             error_file = args.output / (name + '__VERIFY_ERR.txt')
-            error_file.write_text(tb)
+            error_file.write_text(verifier.error)
             data['verify_error'] = htmlify_path(error_file)
 
-        # 3. compile to lambda skia
-        try:
-            pre_expr, path_map = compile_skp_to_lskia(json_skp['commands'])
-            egglog_input = pre_expr.sexp()
-
-            warnings = get_reset_warnings()
-            warning_file: Path = args.output / (name + '__CWARN.txt')
-            if len(warnings) != 0:
-                warning_file.write_text('\n'.join(warnings) + '\n')
-                data['warn_file'] = htmlify_path(warning_file)
-
-            egglog_file: Path = EGG_FOLDER / (name + 'TEST.egg')
-            egglog_file.write_text('(let test ' + egglog_input + ')')
-
-            fmt_file = args.output / (name + '__PRE.txt')
-            pre_fmt = pretty_print_layer(pre_expr)
-            fmt_file.write_text(pre_fmt)
-            data['pre_file'] = htmlify_path(fmt_file)
-
-        except Exception:
-            tb = traceback.format_exc()
-            error_file = args.output / (name + '__PRE_ERR.txt')
-            error_file.write_text(tb)
-            data['compile_error'] = htmlify_path(error_file)
-            data['state'] = 0
-            results.append(data)
-            failed += 1
-            continue
-
-        # 4. optimize in egglog
-        ret_code, egglog_output, stderr = run_egglog(egglog_file)
+    # 3. compile to lambda skia
+    try:
+        pre_expr, path_map = compile_skp_to_lskia(verifier)
+        record_verify_error()
+        data['number_cmds'] = skp_table.number_cmds
+        timer.lap('compile')
+
+        warnings = get_reset_warnings()
+        warning_file: Path = args.output / (name + '__CWARN.txt')
+        if len(warnings) != 0:
+            warning_file.write_text('\n'.join(warnings) + '\n')
+            data['warn_file'] = htmlify_path(warning_file)
+
+        # egglog, if it runs at all, starts from what the peephole rewrites
+        # leave of the term
+        egg_expr = pre_expr
+        if args.engine != 'egglog':
+            egg_expr = peephole(pre_expr)
+            timer.lap('peephole')
+
+        egglog_file: Path = EGG_FOLDER / (name + 'TEST.egg')
+        # Streamed straight to disk, big captures make for terms of many MB
+        with egglog_file.open('w') as f:
+            f.write('(let test ')
+            write_sexp(egg_expr, f)
+            f.write(')')
+        timer.lap('sexp')
+
+        fmt_file = args.output / (name + '__PRE.txt')
+        pre_fmt = pretty_print_layer(pre_expr)
+        fmt_file.write_text(pre_fmt)
+        data['pre_file'] = htmlify_path(fmt_file)
+        timer.lap('pretty_print')
+
+    except Exception:
+        tb = traceback.format_exc()
+        error_file = args.output / (name + '__PRE_ERR.txt')
+        error_file.write_text(tb)
+        data['compile_error'] = htmlify_path(error_file)
+        # Compiling may have stopped early, the rest still needs verifying
+        for _ in verifier:
+            pass
+        record_verify_error()
+        data['number_cmds'] = skp_table.number_cmds
+        data['state'] = 0
+        return data
+
+    # 4. optimize in egglog
+    if args.engine == 'peephole':
+        post_expr = egg_expr
+    else:
+        schedule, budget, limits = egglog_settings(args)
+        # Results of the default way of running egglog keep their old keys
+        salt = repr((args.split, schedule, budget)) if args.split or schedule or budget else ''
+
+        cache = EgglogCache(args.cache, args.cache_size * 2**20) if args.cache else None
+        cache_key = cache.key(egglog_file, salt) if cache else ''
+        egglog_result = cache.get(cache_key) if cache else None
+        if egglog_result is None:
+            if batched is not None:
+                egglog_result = batched
+                data['egglog_batched'] = True
+            elif args.split:
+                egglog_result = optimize_split(egg_expr, args.split_jobs, schedule, budget, limits)
+            else:
+                egglog_result = run_egglog_program(egglog_file, schedule, budget, limits)
+            # Failures are not cached, they may be down to a broken egglog build.
+            # Neither are runs cut short by the clock, which depend on the machine
+            if cache and egglog_result.ret_code == 0 and egglog_result.budget != 'seconds':
+                cache.put(cache_key, egglog_result)
+        else:
+            data['egglog_cached'] = True
+        ret_code, egglog_output, stderr = (
+            egglog_result.ret_code,
+            egglog_result.output,
+            egglog_result.stderr,
+        )
+        data['egglog_time'] = egglog_result.elapsed
+        if egglog_result.stats:
+            data['egglog_stats'] = egglog_result.stats
+        if egglog_result.budget:
+            data['egglog_budget'] = egglog_result.budget
         files = [
             Path('./egg-files/lambda_skia.egg'),
             egglog_file,
             Path('./egg-files/extract.egg'),
         ]
         (args.output / (name + '.txt')).write_text('\n'.join(f.read_text() for f in files))
+        timer.lap('egglog')
 
-        if ret_code == 0:
-            fmt_file = args.output / (name + '__POST.txt')
-            post_expr = parse_sexp(egglog_output)
-            post_fmt = pretty_print_layer(post_expr)
-            fmt_file.write_text(post_fmt)
-            data['post_file'] = htmlify_path(fmt_file)
-
-            egglog_warning_file = args.output / (name + '__EWARN.txt')
-            egglog_warning_file.write_text(stderr)
-        else:
+        if ret_code != 0:
             err_file = args.output / (name + '__POST_ERR.txt')
             err_file.write_text(stderr)
             data['egglog_error'] = htmlify_path(err_file)
             data['state'] = 1
-            results.append(data)
-            failed += 1
+            # Out of time or memory, rather than broken
+            if egglog_result.killed_by:
+                data['killed_by'] = egglog_result.killed_by
+            return data
+
+        post_expr = parse_sexp(egglog_output)
+        timer.lap('parse')
+        egglog_warning_file = args.output / (name + '__EWARN.txt')
+        egglog_warning_file.write_text(stderr)
+
+    fmt_file = args.output / (name + '__POST.txt')
+    post_fmt = pretty_print_layer(post_expr)
+    fmt_file.write_text(post_fmt)
+    data['post_file'] = htmlify_path(fmt_file)
+    timer.lap('pretty_print')
+
+    # 5. Make the diff
+    diff = CleanHtmlDiff().make_file(
+        pre_fmt.splitlines(),
+        post_fmt.splitlines(),
+        fromdesc='Pre Opt',
+        todesc='Post Opt',
+    )
+    diff_file = args.output / (name + '__DIFF.html')
+    diff_file.write_text(diff)
+    data['diff_file'] = htmlify_path(diff_file)
+    timer.lap('diff')
+
+    # 6. Count savelayers
+    before = count_save_layers(pre_expr)
+    after = count_save_layers(post_expr)
+
+    data['counts'] = [before, after]
+
+    # Terms are interned, so egglog handing back the input term yields the very
+    # same object. Its renderings would be identical, so they are made once and
+    # the post artifacts point at the pre ones.
+    unchanged = post_expr is pre_expr
+    data['unchanged_term'] = unchanged
+
+    # Display lists and compiled paints are shared by all renderings below
+    pre_ops = flatten_layer(pre_expr)
+    post_ops = pre_ops if unchanged else flatten_layer(post_expr)
+    paint_cache = {}
+    timer.lap('flatten')
+
+    # 6. draw lambda skia to png
+    pre_png = args.output / (name + '__PRE.png')
+    pre_res = egg_to_png(skp_table, pre_ops, pre_png, path_map, paint_cache)
+
+    if unchanged:
+        post_png, post_res = pre_png, pre_res
+    else:
+        post_png = args.output / (name + '__POST.png')
+        post_res = egg_to_png(skp_table, post_ops, post_png, path_map, paint_cache)
+
+    if isinstance(pre_res, str):
+        pre_png_error = args.output / (name + '__PRE_PNG_ERR.txt')
+        pre_png_error.write_text(pre_res)
+        data['pre_png_err'] = htmlify_path(pre_png_error)
+    else:
+        data['pre_png'] = htmlify_path(pre_png)
+
+    if isinstance(post_res, str):
+        post_png_error = args.output / (name + '__POST_PNG_ERR.txt')
+        post_png_error.write_text(post_res)
+        data['post_png_err'] = htmlify_path(post_png_error)
+    else:
+        data['post_png'] = htmlify_path(post_png)
+    timer.lap('png')
+
+    if unchanged and not isinstance(pre_res, str):
+        data['png_diff_metric'] = 0
+        data['png_diff_rmse'] = 0.0
+    elif not isinstance(pre_res, str) and not isinstance(post_res, str):
+        image_diff = diff_pixels(pre_res, post_res)
+        data['png_diff_metric'] = image_diff.ae
+        data['png_diff_rmse'] = image_diff.rmse
+        # Identical renderings have an infinite PSNR and nothing to show
+        if image_diff.ae != 0:
+            data['png_diff_psnr'] = image_diff.psnr
+            png_diff = args.output / (name + '__PNG_DIFF.png')
+            write_diff_png(pre_res, post_res, png_diff)
+            data['png_diff'] = htmlify_path(png_diff)
+    timer.lap('image_diff')
+
+    # 6. draw lambda skia to png
+    pre_skp = args.output / (name + '__PRE.skp')
+    pre_res = egg_to_skp(skp_table, pre_ops, pre_skp, path_map, paint_cache)
+
+    if unchanged:
+        post_skp, post_res = pre_skp, pre_res
+    else:
+        post_skp = args.output / (name + '__POST.skp')
+        post_res = egg_to_skp(skp_table, post_ops, post_skp, path_map, paint_cache)
+
+    if pre_res is None:
+        data['pre_skp'] = htmlify_path(pre_skp)
+    else:
+        pre_skp_error = args.output / (name + '__PRE_SKP_ERR.txt')
+        pre_skp_error.write_text(pre_res)
+        data['pre_skp_err'] = htmlify_path(pre_skp_error)
+
+    if post_res is None:
+        data['post_skp'] = htmlify_path(post_skp)
+    else:
+        post_skp_error = args.output / (name + '__POST_SKP_ERR.txt')
+        post_skp_error.write_text(post_res)
+        data['post_skp_err'] = htmlify_path(post_skp_error)
+    timer.lap('skp')
+
+    return data
+
+
+def batch_egglog(args: Args, benchmarks: list[Path]) -> dict[str, EgglogResult]:
+    """Optimizes the benchmarks whose JSON is at most --batch-below KiB in one
+    egglog run, see run_egglog_batch, and returns their results by name. Small
+    benchmarks are cheap to compile twice, here and in run_pipeline. Those
+    that are cached already are skipped, and those that fail are left out, so
+    run_pipeline runs them on their own and reports their errors."""
+    assert args.batch_below is not None
+    _, _, limits = egglog_settings(args)
+    cache = EgglogCache(args.cache, args.cache_size * 2**20) if args.cache else None
+
+    names: list[str] = []
+    terms: list[str] = []
+    for benchmark in benchmarks:
+        if benchmark.stat().st_size > args.batch_below * 2**10:
             continue
+        try:
+            expr, _ = compile_skp_to_lskia(stream_skp(benchmark))
+        except Exception:
+            continue
+        finally:
+            # Warnings are reported when run_pipeline compiles it again
+            get_reset_warnings()
+        if args.engine != 'egglog':
+            expr = peephole(expr)
+        term = expr.sexp()
+        if cache and cache.get(cache.key('(let test ' + term + ')')) is not None:
+            continue
+        names.append(benchmark.stem)
+        terms.append(term)
 
-        # 5. Make the diff
-        diff = CleanHtmlDiff().make_file(
-            pre_fmt.splitlines(),
-            post_fmt.splitlines(),
-            fromdesc='Pre Opt',
-            todesc='Post Opt',
-        )
-        diff_file = args.output / (name + '__DIFF.html')
-        diff_file.write_text(diff)
-        data['diff_file'] = htmlify_path(diff_file)
+    if not terms:
+        return {}
+    print(f'optimizing {len(terms)} small benchmarks in one egglog run')
+    results = run_egglog_batch(terms, limits)
+    return {name: result for name, result in zip(names, results) if result.ret_code == 0}
 
-        # 6. Count savelayers
-        before = egglog_input.count('SaveLayer')
-        after = egglog_output.count('SaveLayer')
 
-        data['counts'] = [before, after]
+def collate_data(args: Args):
+    results = []
+    improved = 0
+    unchanged = 0
+    regressed = 0
+    failed = 0
+    # Benchmarks egglog ran out of time or memory on, not counted as failed
+    killed = {'timeout': 0, 'oom': 0}
+    # Track the aggregate number of SaveLayer nodes across successful benchmarks so the
+    # summary view can surface total before/after counts alongside per-benchmark data.
+    savelayer_before_total = 0
+    savelayer_after_total = 0
+    savelayer_successes = 0
+    # Time spent in each stage summed over all benchmarks, in milliseconds
+    stage_totals: dict[str, float] = {}
+
+    # Sorted so that runs are reproducible regardless of filesystem order
+    benchmarks: list[Path] = sorted(args.bench.glob('*.json'))
+
+    # Budgets and schedules are per benchmark, and split jobs are already
+    # separate runs, so none of them go with batching
+    batched: dict[str, EgglogResult] = {}
+    if (
+        args.batch_below is not None
+        and args.engine != 'peephole'
+        and not args.split
+        and egglog_settings(args)[:2] == (None, None)
+    ):
+        batched = batch_egglog(args, benchmarks)
+
+    # A process's peak memory cannot be reset, so measuring it per benchmark
+    # takes a fresh process for each
+    if args.jobs > 1 or args.trace_memory:
+        with ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=close_egglog_at_exit,
+            max_tasks_per_child=1 if args.trace_memory else None,
+        ) as pool:
+            futures = {
+                pool.submit(run_benchmark, args, benchmark, batched.get(benchmark.stem)): benchmark
+                for benchmark in benchmarks
+            }
+            for i, future in enumerate(as_completed(futures)):
+                print(f'[{i + 1}/{len(benchmarks)}] finished ' + str(futures[future]))
+            # Merge in submission order, not completion order, so the counters and
+            # report.json do not depend on scheduling
+            results = [future.result() for future in futures]
+    else:
+        for i, benchmark in enumerate(benchmarks):
+            print(f'[{i + 1}/{len(benchmarks)}] running ' + str(benchmark))
+            results.append(run_benchmark(args, benchmark, batched.get(benchmark.stem)))
+
+    for data in results:
+        for stage, ms in data['timings'].items():
+            stage_totals[stage] = stage_totals.get(stage, 0.0) + ms
+
+        if 'killed_by' in data:
+            killed[data['killed_by']] += 1
+            continue
+        if data['state'] != 2:
+            failed += 1
+            continue
+
+        before, after = data['counts']
 
         # Capture aggregate SaveLayer totals only when we have a successful optimization
-        # run. Later, the HTML summary displays these totals, so guard against missing
-        # data by using the stored counts before adding them to the running sum.
-        counts = data.get('counts')
-        if data['state'] == 2 and isinstance(counts, (list, tuple)) and len(counts) == 2:
-            savelayer_before_total += counts[0]
-            savelayer_after_total += counts[1]
-            savelayer_successes += 1
+        # run. The HTML summary displays these totals alongside the per-benchmark counts.
+        savelayer_before_total += before
+        savelayer_after_total += after
+        savelayer_successes += 1
 
         if before < after:
             regressed += 1
@@ -184,62 +510,8 @@ def collate_data(args: Args):
         else:
             improved += 1
 
-        # 6. draw lambda skia to png
-        pre_png = args.output / (name + '__PRE.png')
-        pre_res = egg_to_png(json_skp, pre_expr, pre_png, path_map)
-
-        post_png = args.output / (name + '__POST.png')
-        post_res = egg_to_png(json_skp, post_expr, post_png, path_map)
-
-        if pre_res is None:
-            data['pre_png'] = htmlify_path(pre_png)
-        else:
-            pre_png_error = args.output / (name + '__PRE_PNG_ERR.txt')
-            pre_png_error.write_text(pre_res)
-            data['pre_png_err'] = htmlify_path(pre_png_error)
-
-        if post_res is None:
-            data['post_png'] = htmlify_path(post_png)
-        else:
-            post_png_error = args.output / (name + '__POST_PNG_ERR.txt')
-            post_png_error.write_text(post_res)
-            data['post_png_err'] = htmlify_path(post_png_error)
-
-        if pre_res is None and post_res is None:
-            png_diff = args.output / (name + '__PNG_DIFF.png')
-            ret, stdout, stderr = run_cmd(f'compare {pre_png} {post_png} {png_diff}'.split())
-            data['png_diff'] = htmlify_path(png_diff)
-            stderr_tokens = stderr.split()
-            if stderr_tokens:
-                try:
-                    data['png_diff_metric'] = float(stderr_tokens[0])
-                except ValueError:
-                    pass
-
-        # 6. draw lambda skia to png
-        pre_skp = args.output / (name + '__PRE.skp')
-        pre_res = egg_to_skp(json_skp, pre_expr, pre_skp, path_map)
-
-        post_skp = args.output / (name + '__POST.skp')
-        post_res = egg_to_skp(json_skp, post_expr, post_skp, path_map)
-
-        if pre_res is None:
-            data['pre_skp'] = htmlify_path(pre_skp)
-        else:
-            pre_skp_error = args.output / (name + '__PRE_SKP_ERR.txt')
-            pre_skp_error.write_text(pre_res)
-            data['pre_skp_err'] = htmlify_path(pre_skp_error)
-
-        if post_res is None:
-            data['post_skp'] = htmlify_path(post_skp)
-        else:
-            post_skp_error = args.output / (name + '__POST_SKP_ERR.txt')
-            post_skp_error.write_text(post_res)
-            data['post_skp_err'] = htmlify_path(post_skp_error)
-
-        results.append(data)
-
     results = sorted(results, key=lambda d: [p.lower() for p in d['name'].split('__', 1)])
+    close_egglog()
 
     json_results = {
         'results': results,
@@ -248,6 +520,8 @@ def collate_data(args: Args):
         'unchanged': unchanged,
         'regressed': regressed,
         'failed': failed,
+        'timeout': killed['timeout'],
+        'oom': killed['oom'],
         # The template consumes these SaveLayer aggregates to display the overall delta
         # for successful benchmarks in the summary header.
         'savelayer_totals': {
@@ -256,6 +530,10 @@ def collate_data(args: Args):
             'delta': savelayer_after_total - savelayer_before_total,
             'benchmarks': savelayer_successes,
         },
+        'stage_totals': stage_totals,
+        # Of this process or the largest of its children and theirs, egglog
+        # included, as the workers are closed by now
+        'peak_rss_mb': max(peak_rss_mb(), peak_rss_mb(resource.RUSAGE_CHILDREN)),
     }
 
     with (args.output / 'report.json').open('w') as f:
@@ -264,12 +542,78 @@ def collate_data(args: Args):
     return json_results
 
 
-if __name__ == '__main__':
+def arg_parser() -> argparse.ArgumentParser:
+    """The command line of this script. Other scripts that run the pipeline
+    parse theirs with it, so they get the same defaults."""
     parser = argparse.ArgumentParser()
     parser.add_argument('bench', type=Path)
     parser.add_argument('rsrc', type=Path)
     parser.add_argument('output', type=Path)
-    args = parser.parse_args(namespace=Args())
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1, help='number of benchmarks to run in parallel'
+    )
+    parser.add_argument(
+        '--cache', type=Path, default=None, help='directory to cache egglog results in'
+    )
+    parser.add_argument(
+        '--cache-size', type=int, default=1024, help='maximum size of the cache in MiB'
+    )
+    parser.add_argument(
+        '--trace-memory',
+        action='store_true',
+        help='record peak memory and Python heap use per benchmark, running each in '
+        'a fresh process, at a cost in speed',
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['egglog', 'peephole', 'peephole+egglog'],
+        default='egglog',
+        help='optimize with egglog, the peephole rewrites, or the latter then the former',
+    )
+    parser.add_argument(
+        '--split',
+        action='store_true',
+        help='optimize the tops of top-level SaveLayers as separate e-graphs',
+    )
+    parser.add_argument(
+        '--split-jobs', type=int, default=2, help='number of e-graphs to optimize at once'
+    )
+    parser.add_argument(
+        '--schedule',
+        default=None,
+        help='rulesets to run in order, each to saturation or a number of iterations, '
+        'e.g. simp,opt:50 (default: as extract.egg)',
+    )
+    parser.add_argument(
+        '--max-iterations', type=int, default=None, help='egglog iterations per benchmark'
+    )
+    parser.add_argument(
+        '--max-enodes', type=int, default=None, help='e-graph size at which egglog stops'
+    )
+    parser.add_argument(
+        '--max-seconds', type=float, default=None, help='seconds egglog may run per benchmark'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=None,
+        help='seconds after which egglog is killed, per benchmark',
+    )
+    parser.add_argument(
+        '--memory-limit', type=int, default=None, help='address space egglog may use, in MiB'
+    )
+    parser.add_argument(
+        '--batch-below',
+        type=int,
+        default=None,
+        metavar='KIB',
+        help='optimize all benchmarks up to this size in a single egglog run',
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args(namespace=Args())
 
     if args.output.exists():
         print('output folder exists, delete before running script', file=sys.stderr)
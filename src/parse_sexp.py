@@ -1,4 +1,6 @@
-from typing import Any
+import re
+from functools import cache
+from typing import Any, Callable
 
 from lark import Lark, Transformer
 
@@ -25,7 +27,7 @@ from lambda_skia import (
 )
 
 # sdakjshdkkajsdh
-grammar = """
+grammar = r"""
 layer: "(Empty)" -> empty
      | "(SaveLayer" layer layer paint ")" -> save_layer
      | "(Draw" layer geometry paint geometry matrix ")" -> draw
@@ -140,9 +142,103 @@ class LambdaSkiaTransformer(Transformer[Any, Layer]):
         return Clip(*node)
 
     def matrix(self, node):
-        return Transform(node)
+        return Transform(tuple(node))
+
+
+@cache
+def lark_parser() -> Lark:
+    # Building the LALR tables is far slower than parsing a typical term, so
+    # it is done once per process and cached on disk between runs. The
+    # transformer runs inline, without building a parse tree first.
+    return Lark(
+        grammar,
+        start='layer',
+        parser='lalr',
+        transformer=LambdaSkiaTransformer(),
+        cache=True,
+    )
+
+
+TOKEN = re.compile(r'\(|\)|[^\s()]+')
+
+# Constructors by head, for the heads that are nodes. Any other nullary head
+# is an enum like (SrcOver) or (Fill) and is kept as a string.
+CONSTRUCTORS: dict[str, Callable[..., Any]] = {
+    'Empty': Empty,
+    'SaveLayer': SaveLayer,
+    'Draw': Draw,
+    'Clip': Clip,
+    'Matrix': lambda *matrix: Transform(matrix),
+    'Full': Full,
+    'Path': Path,
+    'Rect': Rect,
+    'RRect': RRect,
+    'Oval': Oval,
+    'ImageRect': ImageRect,
+    'TextBlob': TextBlob,
+    'Intersect': Intersect,
+    'Difference': Difference,
+    'Paint': Paint,
+    'Color': Color,
+    'RadialGradient': RadialGradient,
+    'LinearGradient': LinearGradient,
+}
+
+
+def atom(token: str) -> Any:
+    if token == 'true':
+        return True
+    if token == 'false':
+        return False
+    # The grammar spells floats with a decimal point and ints without
+    return float(token) if '.' in token else int(token)
+
+
+def read_sexp(sexp_str: str) -> Layer:
+    """Reads a term straight into nodes with a stack of open constructors.
+    Unlike the grammar this does not check which constructors can appear
+    where, parse_sexp falls back to the grammar when this fails."""
+    stack: list[tuple[str, list[Any]]] = []
+    tokens = iter(TOKEN.findall(sexp_str))
+    result: Any = None
+    for token in tokens:
+        if result is not None:
+            raise ValueError(f'trailing {token!r} after term')
+
+        if token == '(':
+            head = next(tokens)
+            if head in '()':
+                raise ValueError('missing constructor')
+            stack.append((head, []))
+        elif token == ')':
+            head, args = stack.pop()
+            constructor = CONSTRUCTORS.get(head)
+            if constructor is not None:
+                node = constructor(*args)
+            elif not args:
+                node = '(' + head + ')'
+            else:
+                raise ValueError(f'unknown constructor {head}')
+
+            if stack:
+                stack[-1][1].append(node)
+            else:
+                result = node
+        else:
+            stack[-1][1].append(atom(token))
+
+    if not isinstance(result, Layer):
+        raise ValueError('not a layer')
+    return result
 
 
 def parse_sexp(sexp_str: str) -> Layer:
-    parser = Lark(grammar, start='layer', parser='lalr')
-    return LambdaSkiaTransformer().transform(parser.parse(sexp_str))
+    try:
+        return read_sexp(sexp_str)
+    except (ValueError, TypeError, IndexError, StopIteration):
+        # The grammar gives a proper error message for malformed terms. Its
+        # transformer builds the layer, lark only knows it returns a tree.
+        layer = lark_parser().parse(sexp_str)
+        if not isinstance(layer, Layer):
+            raise ValueError('not a layer')
+        return layer
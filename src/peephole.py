@@ -0,0 +1,248 @@
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+from typing import Optional
+
+from egglog_runner import run_egglog_program
+from image_diff import diff_pixels
+from lambda_skia import (
+    Clip,
+    Color,
+    Draw,
+    Empty,
+    Geometry,
+    Intersect,
+    Layer,
+    LinearGradient,
+    Paint,
+    Path,
+    Rect,
+    RRect,
+    SaveLayer,
+    Transform,
+    count_save_layers,
+    fold,
+)
+from parse_sexp import parse_sexp
+from renderer import egg_to_png, flatten_layer
+from skp_compiler import compile_skp_to_lskia, get_reset_warnings
+from skp_loader import SkpSideTable, stream_skp
+
+
+def push_clip(layer: Layer, clip: Geometry, transform: Transform) -> Optional[Layer]:
+    """Applies the Clip rewrites: the clip is intersected into every draw of a
+    chain of draws over Empty that all use `transform`. Clip cannot be
+    extracted, so if the chain is anything else there is nothing to gain and
+    None is returned."""
+    draws: list[Draw] = []
+    while isinstance(layer, Draw) and layer.transform is transform:
+        draws.append(layer)
+        layer = layer.bottom
+    if not isinstance(layer, Empty):
+        return None
+
+    result: Layer = layer
+    for draw in reversed(draws):
+        result = Draw(result, draw.shape, draw.paint, Intersect(draw.clip, clip), draw.transform)
+    return result
+
+
+def rewrite_save_layer(bottom: Layer, top: Layer, paint: Paint) -> Layer:
+    """The SaveLayer rules of lambda_skia.egg, applied greedily to a SaveLayer
+    whose bottom and top are rewritten already"""
+    # Draws moved out of the top by REWRITE 3, outermost first
+    peeled: list[Draw] = []
+    original = top
+    while True:
+        match bottom, top, paint:
+            # REWRITE 1
+            case _, Empty(), Paint(Color(1.0), '(SrcOver)', _, '(IdFilter)'):
+                result = bottom
+            # REWRITE 3
+            case (
+                _,
+                Draw(_, _, Paint(Color(), '(SrcOver)')),
+                Paint(Color(1.0), '(SrcOver)', _, '(IdFilter)'),
+            ):
+                assert isinstance(top, Draw)
+                peeled.append(top)
+                top = top.bottom
+                continue
+            # REWRITE 2
+            case Empty(), Draw(Empty()), Paint(Color(1.0), '(SrcOver)', _, '(IdFilter)'):
+                result = top
+            # DstIn masks by a rect, rrect or path
+            case (
+                _,
+                Draw(
+                    Empty(),
+                    Rect() | RRect() | Path() as shape,
+                    Paint(Color(1.0), '(SrcOver)', '(Solid)', '(IdFilter)'),
+                    clip,
+                    transform,
+                ),
+                Paint(Color(1.0), '(DstIn)', _, '(IdFilter)'),
+            ) if (clipped := push_clip(bottom, Intersect(shape, clip), transform)) is not None:
+                result = clipped
+            # Luminance masks
+            case (
+                Empty(),
+                Draw(
+                    Empty(),
+                    shape,
+                    Paint(Color(1.0, 1.0, 1.0, 1.0), '(SrcOver)', style, '(IdFilter)', index),
+                    clip,
+                    transform,
+                ),
+                Paint(Color(1.0), '(SrcOver)', _, '(LumaFilter)'),
+            ):
+                black = Paint(Color(1.0, 0.0, 0.0, 0.0), '(SrcOver)', style, '(IdFilter)', index)
+                result = Draw(Empty(), shape, black, clip, transform)
+            # Gradient clips
+            case (
+                Draw(
+                    Empty(),
+                    shape,
+                    Paint(Color(), '(SrcOver)', style, '(IdFilter)'),
+                    clip,
+                    transform,
+                ),
+                Draw(
+                    Empty(),
+                    mask_shape,
+                    Paint(LinearGradient(True), '(SrcOver)', mask_style, '(IdFilter)'),
+                    mask_clip,
+                    mask_transform,
+                ),
+                Paint(Color(1.0), '(DstIn)', _, '(IdFilter)'),
+            ) if (
+                mask_shape is shape
+                and mask_clip is clip
+                and mask_transform is transform
+                and mask_style == style
+            ):
+                result = bottom
+            case _:
+                # Peeling draws off a SaveLayer that stays gains nothing, and
+                # egglog keeps them in the layer
+                result = SaveLayer(bottom, original, paint)
+                peeled.clear()
+        break
+
+    for draw in reversed(peeled):
+        result = Draw(result, draw.shape, draw.paint, draw.clip, draw.transform)
+    return result
+
+
+def peephole(layer: Layer) -> Layer:
+    """Rewrites a term bottom up with the local rules of lambda_skia.egg, in a
+    single pass. Each rule is applied as soon as it matches, rather than
+    saturating an e-graph and extracting the cheapest term, so the result can
+    be worse than egglog's but never better. It is equivalent to the input, and a
+    cheap way to shrink a term before handing it to egglog."""
+
+    def rewrite(node: Layer, memo: dict[Layer, Layer]) -> Layer:
+        match node:
+            case SaveLayer(bottom, top, paint):
+                return rewrite_save_layer(memo[bottom], memo[top], paint)
+            case Draw(bottom, shape, paint, clip, transform):
+                return Draw(memo[bottom], shape, paint, clip, transform)
+            case Clip(inner, clip, transform):
+                pushed = push_clip(memo[inner], clip, transform)
+                return Clip(memo[inner], clip, transform) if pushed is None else pushed
+            case _:
+                return node
+
+    return fold(layer, rewrite, Layer)
+
+
+def check_benchmark(benchmark: pathlib.Path) -> list[str]:
+    """Runs the peephole rewriter and egglog on a benchmark and returns how
+    their results differ. The rewriter must render the same image as the
+    input and never do better than egglog, and egglog must extract the same
+    term after the rewriter as without it."""
+    skp_table = SkpSideTable()
+    try:
+        pre_expr, path_map = compile_skp_to_lskia(stream_skp(benchmark, skp_table))
+    except Exception as e:
+        # Nothing to compare, the report shows these as compile errors
+        print(f'{benchmark.stem}: does not compile ({type(e).__name__}), skipped')
+        return []
+    finally:
+        get_reset_warnings()
+
+    start = time.perf_counter()
+    rewritten = peephole(pre_expr)
+    elapsed = time.perf_counter() - start
+
+    egglog = run_egglog_program('(let test ' + pre_expr.sexp() + ')')
+    prepass = run_egglog_program('(let test ' + rewritten.sexp() + ')')
+    if egglog.ret_code != 0 or prepass.ret_code != 0:
+        return ['egglog failed: ' + (egglog.stderr or prepass.stderr).strip()]
+
+    egglog_expr = parse_sexp(egglog.output)
+    prepass_expr = parse_sexp(prepass.output)
+    counts = (
+        count_save_layers(pre_expr),
+        count_save_layers(rewritten),
+        count_save_layers(egglog_expr),
+        count_save_layers(prepass_expr),
+    )
+    print(
+        f'{benchmark.stem}: {counts[0]} SaveLayers, peephole {counts[1]} in {elapsed:.3f}s, '
+        f'egglog {counts[2]} in {egglog.elapsed:.3f}s, both {counts[3]} in {prepass.elapsed:.3f}s'
+        + (', identical to egglog' if rewritten is egglog_expr else '')
+    )
+
+    mismatches: list[str] = []
+    if counts[1] < counts[2]:
+        mismatches.append(f'peephole left {counts[1]} SaveLayers, fewer than egglog ({counts[2]})')
+    # Terms are interned, so the same term is the same object
+    if prepass_expr is not egglog_expr:
+        mismatches.append(
+            f'egglog after peephole extracted a different term, with {counts[3]} SaveLayers '
+            f'to {counts[2]}'
+        )
+
+    if rewritten is not pre_expr:
+        paint_cache = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            pre_png = egg_to_png(
+                skp_table,
+                flatten_layer(pre_expr),
+                pathlib.Path(tmp) / 'pre.png',
+                path_map,
+                paint_cache,
+            )
+            post_png = egg_to_png(
+                skp_table,
+                flatten_layer(rewritten),
+                pathlib.Path(tmp) / 'post.png',
+                path_map,
+                paint_cache,
+            )
+        if isinstance(pre_png, str):
+            mismatches.append('rendering the input failed: ' + pre_png)
+        elif isinstance(post_png, str):
+            mismatches.append('rendering the peephole output failed: ' + post_png)
+        elif (ae := diff_pixels(pre_png, post_png).ae) != 0:
+            mismatches.append(f'peephole output renders {ae} pixels differently')
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='check the peephole rewriter against egglog on every benchmark'
+    )
+    parser.add_argument('bench', type=pathlib.Path, help='a JSON skp, or a folder of them')
+    args = parser.parse_args()
+
+    benchmarks = sorted(args.bench.glob('*.json')) if args.bench.is_dir() else [args.bench]
+    failed = False
+    for benchmark in benchmarks:
+        for mismatch in check_benchmark(benchmark):
+            print(f'{benchmark.stem}: {mismatch}', file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -1,13 +1,16 @@
 import io
 import traceback
 from contextlib import redirect_stdout
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
+import numpy as np
 import skia  # pyrefly: ignore
 
 # https://github.com/bhargavkulk/easteregg/blob/9646d8c2fcc2e90c01b5a74745f574a5bf9de58a/eegg2png.py
 import lambda_skia as ast
+from skp_loader import SkpSideTable
 
 BLEND_MODES = {
     '(SrcOver)': skia.BlendMode.kSrcOver,
@@ -29,6 +32,52 @@ def extract_tile_mode(flags: int) -> int:
     return (flags >> 8) & 0xF
 
 
+# What a compiled skia.Paint depends on: the command the paint comes from, plus
+# the fill, blend mode, style and filter the optimizer may have rewritten
+type PaintKey = tuple[int, ast.Fill, ast.BlendMode, ast.Style, ast.Filter]
+
+
+@dataclass(frozen=True, slots=True)
+class DrawOp:
+    shape: ast.Geometry
+    paint: ast.Paint
+    clip: ast.Geometry
+    transform: ast.Transform
+
+
+@dataclass(frozen=True, slots=True)
+class SaveLayerOp:
+    paint: ast.Paint
+
+
+@dataclass(frozen=True, slots=True)
+class RestoreOp:
+    pass
+
+
+type DisplayOp = DrawOp | SaveLayerOp | RestoreOp
+
+
+def flatten_layer(layer: ast.Layer) -> list[DisplayOp]:
+    """Flattens a layer into the list of ops that draws it, bottom first"""
+
+    def expand(item: ast.Layer | DisplayOp) -> Optional[list[ast.Layer | DisplayOp]]:
+        match item:
+            case ast.SaveLayer(bottom, top, paint):
+                return [bottom, SaveLayerOp(paint), top, RestoreOp()]
+            case ast.Draw(bottom, shape, paint, clip, transform):
+                return [bottom, DrawOp(shape, paint, clip, transform)]
+            case ast.Layer():
+                # Empty()
+                return []
+            case _:
+                return None
+
+    return [
+        op for op in ast.walk(layer, expand) if isinstance(op, (DrawOp, SaveLayerOp, RestoreOp))
+    ]
+
+
 def path_to_str(path: skia.Path) -> str:
     buffer = io.StringIO()
     with redirect_stdout(buffer):
@@ -36,21 +85,43 @@ def path_to_str(path: skia.Path) -> str:
     return buffer.getvalue()
 
 
+def rect_to_path(rect: skia.Rect) -> skia.Path:
+    path = skia.Path()
+    path.addRect(rect)
+    return path
+
+
+def intersect_rects(a: skia.Rect, b: skia.Rect) -> skia.Rect:
+    rect = skia.Rect.MakeLTRB(
+        max(a.left(), b.left()),
+        max(a.top(), b.top()),
+        min(a.right(), b.right()),
+        min(a.bottom(), b.bottom()),
+    )
+    return skia.Rect.MakeEmpty() if rect.isEmpty() else rect
+
+
 class Renderer:
     def __init__(
         self,
-        skp_json: dict[str, Any],
+        paints: dict[int, dict[str, Any]],
         path_map: dict[int, skia.Path],
         width: int = 512,
         height: int = 512,
         png: bool = True,
+        paint_cache: Optional[dict[PaintKey, skia.Paint]] = None,
     ):
-        """Initialize renderer with SKP data and canvas dimensions."""
+        """Initialize renderer with the SKP's paints (by command index) and
+        canvas dimensions. Renderers of
+        the same SKP can pass the same paint_cache to share compiled paints."""
         self.width = width
         self.height = height
         self.png = png
-        self.skp_json = skp_json
+        self.paints = paints
         self.path_map = path_map
+        self.paint_cache = {} if paint_cache is None else paint_cache
+        # Resolved clips, keyed by the (interned) clip geometry
+        self.clip_cache: dict[ast.Geometry, skia.Rect | skia.Path] = {}
         if png:
             self.surface = skia.Surface(width, height)
             self.canvas = self.surface.getCanvas()
@@ -66,15 +137,28 @@ class Renderer:
         # image.save takes a string not Path objext, so convert to string
         image.save(str(output), skia.kPNG)
 
+    def pixels(self) -> np.ndarray:
+        """The rendered raster as an HxWx4 RGBA uint8 array"""
+        assert self.png
+        image = self.surface.makeImageSnapshot()
+        return image.toarray(colorType=skia.ColorType.kRGBA_8888_ColorType)
+
     def to_skp(self, output: Path):
         assert not self.png
         picture = self.recorder.finishRecordingAsPicture()
         with output.open('wb') as f:
             f.write(picture.serialize().bytes())
 
-    def mk_paint(self, paint: ast.Paint):
+    def mk_paint(self, paint: ast.Paint) -> skia.Paint:
+        key = (paint.index, paint.fill, paint.blend_mode, paint.style, paint.color_filter)
+        skpaint = self.paint_cache.get(key)
+        if skpaint is None:
+            skpaint = self.paint_cache[key] = self.compile_paint(paint)
+        return skpaint
+
+    def compile_paint(self, paint: ast.Paint) -> skia.Paint:
         skpaint = skia.Paint()
-        json_paint = self.skp_json['commands'][paint.index].get('paint', None)
+        json_paint = self.paints.get(paint.index, None)
 
         # Add Fill
         match paint.fill:
@@ -82,7 +166,7 @@ class Renderer:
                 skpaint.setColor4f(skia.Color4f(r, g, b, a))
             case ast.LinearGradient():
                 # fetch the gradient from the paint from the skp directly
-                json_shader: dict = self.skp_json['commands'][paint.index]['paint']['shader']
+                json_shader: dict = self.paints[paint.index]['shader']
 
                 # get the matrix
                 flat_matrix = [float(x) for row in json_shader['values']['00_matrix'] for x in row]
@@ -166,7 +250,7 @@ class Renderer:
                         )
                 pass
             case ast.RadialGradient():
-                json_shader: dict = self.skp_json['commands'][paint.index]['paint']['shader']
+                json_shader: dict = self.paints[paint.index]['shader']
 
                 flat_matrix = [float(x) for row in json_shader['values']['00_matrix'] for x in row]
                 assert len(flat_matrix) == 9
@@ -306,25 +390,25 @@ class Renderer:
         return path
 
     def render_layer(self, layer: ast.Layer) -> None:
-        """Recursively render a layer tree to the canvas."""
-        match layer:
-            case ast.SaveLayer(bottom, top, paint):
-                self.render_layer(bottom)
-                skpaint = self.mk_paint(paint)
-                self.canvas.saveLayer(paint=skpaint)
-                self.render_layer(top)
-                self.canvas.restore()
-            case ast.Draw(bottom, shape, paint, clip, transform):
-                self.render_layer(bottom)
-                self.canvas.save()
-                self.new_clip_geometry(clip)
-                self.transform(transform)
-                skpaint = self.mk_paint(paint)
-                self.render_geometry(shape, skpaint)
-                self.canvas.restore()
-            case _:
-                # Empty()
-                pass
+        """Render a layer tree to the canvas."""
+        self.render_ops(flatten_layer(layer))
+
+    def render_ops(self, ops: list[DisplayOp]) -> None:
+        """Replay a display list made by flatten_layer on the canvas."""
+        for op in ops:
+            match op:
+                case DrawOp(shape, paint, clip, transform):
+                    self.canvas.save()
+                    self.new_clip_geometry(clip)
+                    self.transform(transform)
+                    skpaint = self.mk_paint(paint)
+                    self.render_geometry(shape, skpaint)
+                    self.canvas.restore()
+                case SaveLayerOp(paint):
+                    skpaint = self.mk_paint(paint)
+                    self.canvas.saveLayer(paint=skpaint)
+                case RestoreOp():
+                    self.canvas.restore()
 
     def render_geometry(self, geometry: ast.Geometry, skpaint) -> None:
         """Execute drawing commands for the given geometry."""
@@ -356,17 +440,25 @@ class Renderer:
                 raise NotImplementedError(f'Geometry type {type(geometry)} not implemented')
 
     def geometry_to_path(self, geometry: ast.Geometry) -> skia.Path:
-        canvas_bounds = skia.Rect.MakeWH(self.width, self.height)
-
+        clip = self.geometry_to_clip(geometry)
+        return clip if isinstance(clip, skia.Path) else rect_to_path(clip)
+
+    def geometry_to_clip(self, geometry: ast.Geometry) -> skia.Rect | skia.Path:
+        """Resolves a clip geometry to the region it covers. Geometries are
+        interned, so the many draws that share a clip (or a prefix of one) hit
+        the cache instead of redoing the path ops. Intersections of rects stay
+        a skia.Rect, so they can be applied with clipRect."""
+        clip = self.clip_cache.get(geometry)
+        if clip is None:
+            clip = self.clip_cache[geometry] = self.resolve_clip(geometry)
+        return clip
+
+    def resolve_clip(self, geometry: ast.Geometry) -> skia.Rect | skia.Path:
         match geometry:
             case ast.Full():
-                path = skia.Path()
-                path.addRect(canvas_bounds)
-                return path
+                return skia.Rect.MakeWH(self.width, self.height)
             case ast.Rect(l, t, r, b):
-                path = skia.Path()
-                path.addRect(l, t, r, b)
-                return path
+                return skia.Rect.MakeLTRB(l, t, r, b)
             case ast.RRect():
                 path = skia.Path()
                 assert isinstance(geometry, ast.RRect)
@@ -378,14 +470,21 @@ class Renderer:
                 return path2
             case ast.Intersect(left, right):
                 if isinstance(left, ast.Full):
-                    return self.geometry_to_path(right)
+                    return self.geometry_to_clip(right)
                 if isinstance(right, ast.Full):
-                    return self.geometry_to_path(left)
+                    return self.geometry_to_clip(left)
 
-                left_path = self.geometry_to_path(left)
-                right_path = self.geometry_to_path(right)
+                left_clip = self.geometry_to_clip(left)
+                right_clip = self.geometry_to_clip(right)
+
+                if isinstance(left_clip, skia.Rect) and isinstance(right_clip, skia.Rect):
+                    return intersect_rects(left_clip, right_clip)
 
-                return skia.Op(left_path, right_path, skia.PathOp.kIntersect_PathOp)
+                return skia.Op(
+                    self.geometry_to_path(left),
+                    self.geometry_to_path(right),
+                    skia.PathOp.kIntersect_PathOp,
+                )
             case ast.Difference(left, right):
                 if isinstance(right, ast.Full):
                     return skia.Path()
@@ -394,11 +493,16 @@ class Renderer:
                 right_path = self.geometry_to_path(right)
 
                 return skia.Op(left_path, right_path, skia.PathOp.kDifference_PathOp)
+            case _:
+                raise ValueError(f'Invalid geometry type {type(geometry)} for clipping')
 
     def new_clip_geometry(self, geometry: ast.Geometry) -> None:
         if not isinstance(geometry, ast.Full):
-            clip_path = self.geometry_to_path(geometry)
-            self.canvas.clipPath(clip_path)
+            clip = self.geometry_to_clip(geometry)
+            if isinstance(clip, skia.Rect):
+                self.canvas.clipRect(clip)
+            else:
+                self.canvas.clipPath(clip)
 
     def clip_geometry(self, geometry: ast.Geometry) -> None:
         """Apply clipping operations to the canvas for the given geometry."""
@@ -440,25 +544,26 @@ class Renderer:
         self.canvas.setMatrix(skia_m44)
 
 
-def egg_to_png(json, layer, output_file, path_map):
-    """Writes egg file to png at 'output_file'"""
+def egg_to_png(skp: SkpSideTable, ops, output_file, path_map, paint_cache=None):
+    """Writes the display list of an egg file to png at 'output_file'. Returns
+    the rendered pixels, or the traceback if rendering failed."""
     try:
-        w, h = json.get('dim', (512, 512))
-        renderer = Renderer(json, path_map, w, h)
-        renderer.render_layer(layer)
+        w, h = skp.dim
+        renderer = Renderer(skp.paints, path_map, w, h, paint_cache=paint_cache)
+        renderer.render_ops(ops)
         renderer.to_png(output_file)
-        return
+        return renderer.pixels()
     except Exception:
         tb = traceback.format_exc()
         return str(tb)
 
 
-def egg_to_skp(json, layer, output_file, path_map):
-    """Writes egg file to skp at 'output_file'"""
+def egg_to_skp(skp: SkpSideTable, ops, output_file, path_map, paint_cache=None):
+    """Writes the display list of an egg file to skp at 'output_file'"""
     try:
-        w, h = json.get('dim', (512, 512))
-        renderer = Renderer(json, path_map, w, h, png=False)
-        renderer.render_layer(layer)
+        w, h = skp.dim
+        renderer = Renderer(skp.paints, path_map, w, h, png=False, paint_cache=paint_cache)
+        renderer.render_ops(ops)
         renderer.to_skp(output_file)
         return
     except Exception:
@@ -1,10 +1,8 @@
 import argparse
-import json
 import pathlib
 from contextvars import ContextVar
-from copy import deepcopy
-from dataclasses import dataclass
-from typing import Any, Literal, Optional
+from dataclasses import dataclass, replace
+from typing import Any, Iterable, Literal, Optional, Sequence
 
 import numpy as np
 import skia  # pyrefly: ignore
@@ -32,6 +30,7 @@ from lambda_skia import (
     Transform,
     mk_color,
 )
+from skp_loader import stream_skp
 
 warnings_var: ContextVar[list[str]] = ContextVar('warnings', default=[])
 
@@ -48,23 +47,24 @@ def warn(msg):
     warnings_var.set(warnings)
 
 
-I = [1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0]
+I = (1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0)
 
 
-def mm(a, b):
-    result = [0.0] * 16
-    for i in range(4):
-        for j in range(4):
-            for k in range(4):
-                result[i * 4 + j] += a[i * 4 + k] * b[k * 4 + j]
-    return result
+def mm(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # Summed term by term rather than with `a @ b`, so the rounding is the same
+    # whichever BLAS numpy was built with
+    return a[:, [0]] * b[0] + a[:, [1]] * b[1] + a[:, [2]] * b[2] + a[:, [3]] * b[3]
 
 
 def radii_to_ltrb(radii: list[list[float]]) -> list[float]:
     return sum(radii, [])
 
 
-def to_matrix33(matrix: list[float]) -> skia.Matrix:
+# Rows and columns of a 4x4 matrix that make up its SkMatrix
+M33 = [0, 1, 3]
+
+
+def to_matrix33(matrix: np.ndarray) -> skia.Matrix:
     """When converting from SkM44 to SkMatrix, the third row and
     column is dropped.  When converting from SkMatrix to SkM44
     the third row and column remain as identity:
@@ -74,20 +74,30 @@ def to_matrix33(matrix: list[float]) -> skia.Matrix:
     [ g h 0 i ]
     """
 
-    m33: list[float] = [
-        matrix[0],
-        matrix[1],
-        matrix[3],
-        matrix[4],
-        matrix[5],
-        matrix[7],
-        matrix[12],
-        matrix[13],
-        matrix[15],
-    ]
+    return skia.Matrix(matrix[np.ix_(M33, M33)].astype(np.float32))
+
 
-    m33_array = np.array(m33, dtype=np.float32).reshape(3, 3)
-    return skia.Matrix(m33_array)
+def map_rect(matrix: np.ndarray, ltrb: Sequence[float]) -> Optional[tuple[float, ...]]:
+    """Maps a rect the way transforming a rect skia.Path and reading back its
+    bounds does, but without building the path: both corners are mapped at
+    once in float32 and the result sorted. Only scale+translate matrices keep
+    a rect a rect, for anything else (or when the result is not a proper rect)
+    this returns None and the caller has to go through skia.Path."""
+    m33 = matrix[np.ix_(M33, M33)].astype(np.float32)
+    if m33[0, 1] or m33[1, 0] or m33[2, 0] or m33[2, 1] or m33[2, 2] != 1:
+        return None
+
+    corners = np.array(ltrb, dtype=np.float32).reshape(2, 2)
+    # Skia leaves points alone under the identity and otherwise scales and
+    # translates, which matters for the sign of zeros
+    if m33[0, 0] != 1 or m33[1, 1] != 1 or m33[0, 2] or m33[1, 2]:
+        with np.errstate(over='ignore', invalid='ignore'):
+            corners = corners * m33[[0, 1], [0, 1]] + m33[[0, 1], [2, 2]]
+
+    (l, t), (r, b) = np.sort(corners, axis=0).tolist()
+    if not (l < r and t < b and np.isfinite(corners).all()):
+        return None
+    return l, t, r, b
 
 
 def path_to_rect(skpath: skia.Path) -> Optional[Rect]:
@@ -136,26 +146,36 @@ def path_to_oval(skpath: skia.Path) -> Optional[Oval]:
 type ClipOp = Literal['intersect'] | Literal['difference']
 
 
-@dataclass
+@dataclass(frozen=True)
 class State:
+    """A frame of the Save/SaveLayer stack. Frames are never mutated, a new
+    frame is pushed or swapped in instead. Since λSkia nodes are immutable too,
+    a Save can share everything with the frame below it."""
+
     clip: Geometry
-    transform: list[float]
+    transform: np.ndarray  # 4x4 float64, never written to
     layer: Layer
     is_save_layer: bool
     paint: Optional[Paint]  # Only not none, if is_save_layer is True
 
 
-def compile_skp_to_lskia(commands: list[dict[str, Any]]) -> tuple[Layer, skia.Path]:
+def compile_skp_to_lskia(commands: Iterable[dict[str, Any]]) -> tuple[Layer, skia.Path]:
     """Compiles serialized Skia commands into λSkia"""
-    stack: list[State] = [State(Full(), I, Empty(), False, None)]
+    stack: list[State] = [State(Full(), np.identity(4), Empty(), False, None)]
     path_map: dict[int, skia.Path] = dict()
-    path_index = 0
-
-    def insert_in_path_map(path: skia.Path) -> int:
-        nonlocal path_index
-        path_map[path_index] = path
-        path_index += 1
-        return path_index - 1
+    # Paths by their serialization (verbs, points and fill type), so that
+    # geometry a page repeats, like icons or rounded clips, shares one entry in
+    # path_map and one Path node, named after the first command that drew it
+    path_nodes: dict[bytes, Path] = dict()
+
+    def intern_path(path: skia.Path, i: int) -> Path:
+        key = path.serialize().bytes()
+        node = path_nodes.get(key)
+        if node is None:
+            index = len(path_map)
+            path_map[index] = path
+            node = path_nodes[key] = Path(i, index)
+        return node
 
     for i, command_data in enumerate(commands):
 
@@ -229,17 +249,18 @@ def compile_skp_to_lskia(commands: list[dict[str, Any]]) -> tuple[Layer, skia.Pa
             # [..., s(m, c, l, b, p)]
             # -->
             # [..., s(m, op(c, g), l, b, p)]
-            stack[-1].clip = (Intersect if op == 'intersect' else Difference)(stack[-1].clip, g)
+            clip = (Intersect if op == 'intersect' else Difference)(stack[-1].clip, g)
+            stack[-1] = replace(stack[-1], clip=clip)
 
-        def push_transform(m: list[float]):
+        def push_transform(m: np.ndarray):
             # given m₂
             # [..., s(m₁, c, l, b, p)]
             # -->
             # [..., s(m₁ × m₂, c, l, b, p)]
-            stack[-1].transform = mm(stack[-1].transform, m)
+            stack[-1] = replace(stack[-1], transform=mm(stack[-1].transform, m))
 
         def identity_transform() -> Transform:
-            return Transform(I.copy())
+            return Transform(I)
 
         def mk_draw(g: Geometry):
             p = compile_paint(command_data.get('paint', None))
@@ -247,30 +268,31 @@ def compile_skp_to_lskia(commands: list[dict[str, Any]]) -> tuple[Layer, skia.Pa
             # [..., s(m, c, l, b, p')]
             # -->
             # [..., s(m, c, Draw(l, g, p, c, m), b, p')]
-            stack[-1].layer = Draw(
+            layer = Draw(
                 stack[-1].layer,
                 g,
                 p,
                 stack[-1].clip,
                 identity_transform(),
             )
+            stack[-1] = replace(stack[-1], layer=layer)
 
         match command := command_data['command']:
             case 'Save':
                 # [..., s₁(m, c, l, b, p)]
                 # -->
                 # [..., s₁(m, c, l, b, p), s₂(m, c, l, b, p)]
-                new_state = deepcopy(stack[-1])
-                new_state.is_save_layer = False
-                stack.append(new_state)
+                stack.append(replace(stack[-1], is_save_layer=False))
             case 'SaveLayer':
                 # given p₁
                 # [..., s₁(m, c, l, b, p₁)]
                 # [..., s₁(m, c, l, b, p₁), s₂(m, c, Empty(), b, p₂)]
-                new_state = deepcopy(stack[-1])
-                new_state.layer = Empty()
-                new_state.is_save_layer = True
-                new_state.paint = compile_paint(command_data.get('paint', None))
+                new_state = replace(
+                    stack[-1],
+                    layer=Empty(),
+                    is_save_layer=True,
+                    paint=compile_paint(command_data.get('paint', None)),
+                )
                 stack.append(new_state)
             case 'Restore':
                 saved_state: State = stack.pop()
@@ -279,54 +301,55 @@ def compile_skp_to_lskia(commands: list[dict[str, Any]]) -> tuple[Layer, skia.Pa
                     # [..., s₁(m₁, c₁, l₁, b₁, p₁), s₂(m₂, c₂, l₂, True, p₂)]
                     # -->
                     # [..., s₁(m₁, c₁, SaveLayer(l₁, l₂, p₂), b₁, p₁)]
-                    stack[-1].layer = SaveLayer(
-                        stack[-1].layer, saved_state.layer, saved_state.paint
-                    )
+                    layer = SaveLayer(stack[-1].layer, saved_state.layer, saved_state.paint)
+                    stack[-1] = replace(stack[-1], layer=layer)
                 else:
                     # [..., s₁(m₁, c₁, l₁, b₁, p₁), s₂(m₂, c₂, l₂, True, None)]
                     # -->
                     # [..., s₁(m₁, c₁, l₂, b₁, p₁)]
-                    stack[-1].layer = saved_state.layer
+                    stack[-1] = replace(stack[-1], layer=saved_state.layer)
             case 'DrawPaint':
                 mk_draw(Full())
             case 'DrawTextBlob':
                 x = float(command_data['x'])
                 y = float(command_data['y'])
                 bounds = [float(bound) for bound in command_data['bounds']]
-                rect = skia.Rect.MakeLTRB(
-                    x + bounds[0],
-                    y + bounds[1],
-                    x + bounds[2],
-                    y + bounds[3],
-                )
-                skpath = skia.Path.Rect(rect)
-                skpath.transform(to_matrix33(stack[-1].transform))
-                tight_bounds = skpath.computeTightBounds()
-                assert tight_bounds is not None
-                left = tight_bounds.left()
-                top = tight_bounds.top()
-                right = tight_bounds.right()
-                bottom = tight_bounds.bottom()
+                ltrb = [x + bounds[0], y + bounds[1], x + bounds[2], y + bounds[3]]
+                mapped = map_rect(stack[-1].transform, ltrb)
+                if mapped is None:
+                    skpath = skia.Path.Rect(skia.Rect.MakeLTRB(*ltrb))
+                    skpath.transform(to_matrix33(stack[-1].transform))
+                    tight_bounds = skpath.computeTightBounds()
+                    assert tight_bounds is not None
+                    mapped = (
+                        tight_bounds.left(),
+                        tight_bounds.top(),
+                        tight_bounds.right(),
+                        tight_bounds.bottom(),
+                    )
+                left, top, right, bottom = mapped
                 mk_draw(TextBlob(left, top, 0.0, 0.0, right - left, bottom - top))
             case 'DrawImageRect':
                 dst = [float(d) for d in command_data['dst']]
-                skrect = skia.Rect.MakeLTRB(*dst)
-                skpath = skia.Path.Rect(skrect)
-                skpath.transform(to_matrix33(stack[-1].transform))
-                image_rect = path_to_image_rect(skpath)
+                mapped = map_rect(stack[-1].transform, dst)
+                if mapped is None:
+                    skpath = skia.Path.Rect(skia.Rect.MakeLTRB(*dst))
+                    skpath.transform(to_matrix33(stack[-1].transform))
+                    image_rect = path_to_image_rect(skpath)
+                else:
+                    image_rect = ImageRect(*mapped)
                 assert image_rect is not None, 'cant transform image rect'
                 mk_draw(image_rect)
             case 'DrawRect':
                 coords = [float(coord) for coord in command_data['coords']]
-                skrect_pre = skia.Rect.MakeLTRB(*coords)
-                skpath = skia.Path.Rect(skrect_pre)
-                skpath.transform(to_matrix33(stack[-1].transform))
-                rect = path_to_rect(skpath)
-                if rect is None:
-                    index = insert_in_path_map(skpath)
-                    geometry: Geometry = Path(i, index)
+                mapped = map_rect(stack[-1].transform, coords)
+                if mapped is not None:
+                    geometry: Geometry = Rect(*mapped)
                 else:
-                    geometry = rect
+                    skpath = skia.Path.Rect(skia.Rect.MakeLTRB(*coords))
+                    skpath.transform(to_matrix33(stack[-1].transform))
+                    rect = path_to_rect(skpath)
+                    geometry = intern_path(skpath, i) if rect is None else rect
                 mk_draw(geometry)
             case 'DrawOval':
                 coords = [float(coord) for coord in command_data['coords']]
@@ -346,28 +369,25 @@ def compile_skp_to_lskia(commands: list[dict[str, Any]]) -> tuple[Layer, skia.Pa
                 skpath.transform(to_matrix33(stack[-1].transform))
                 rrect_geometry = path_to_rrect(skpath)
                 if rrect_geometry is None:
-                    index = insert_in_path_map(skpath)
-                    geometry = Path(i, index)
+                    geometry = intern_path(skpath, i)
                 else:
                     geometry = rrect_geometry
                 mk_draw(geometry)
             case 'DrawPath':
                 skpath = Path.from_jsonpath(command_data['path'])
                 skpath.transform(to_matrix33(stack[-1].transform))
-                index = insert_in_path_map(skpath)
-                mk_draw(Path(i, index))
+                mk_draw(intern_path(skpath, i))
             case 'ClipRect':
                 coords = [float(coord) for coord in command_data['coords']]
                 op: ClipOp = command_data['op']
-                skrect_pre = skia.Rect.MakeLTRB(*coords)
-                skpath = skia.Path.Rect(skrect_pre)
-                skpath.transform(to_matrix33(stack[-1].transform))
-                rect = path_to_rect(skpath)
-                if rect is None:
-                    index = insert_in_path_map(skpath)
-                    geometry: Geometry = Path(i, index)
+                mapped = map_rect(stack[-1].transform, coords)
+                if mapped is not None:
+                    geometry: Geometry = Rect(*mapped)
                 else:
-                    geometry = rect
+                    skpath = skia.Path.Rect(skia.Rect.MakeLTRB(*coords))
+                    skpath.transform(to_matrix33(stack[-1].transform))
+                    rect = path_to_rect(skpath)
+                    geometry = intern_path(skpath, i) if rect is None else rect
                 push_clip(geometry, op)
             case 'ClipRRect':
                 coords, *radii = command_data['coords']
@@ -379,20 +399,17 @@ def compile_skp_to_lskia(commands: list[dict[str, Any]]) -> tuple[Layer, skia.Pa
                 skpath.transform(to_matrix33(stack[-1].transform))
                 rrect_geometry = path_to_rrect(skpath)
                 if rrect_geometry is None:
-                    index = insert_in_path_map(skpath)
-                    geometry = Path(i, index)
+                    geometry = intern_path(skpath, i)
                 else:
                     geometry = rrect_geometry
                 push_clip(geometry, op)
             case 'ClipPath':
                 skpath = Path.from_jsonpath(command_data['path'])
                 skpath.transform(to_matrix33(stack[-1].transform))
-                index = insert_in_path_map(skpath)
                 op: ClipOp = command_data['op']
-                push_clip(Path(i, index), op)
+                push_clip(intern_path(skpath, i), op)
             case 'Concat44':
-                matrix: list[float] = [i for s in command_data['matrix'] for i in s]
-                push_transform(matrix)
+                push_transform(np.array(command_data['matrix'], dtype=np.float64))
             case _:
                 raise NotImplementedError(command + ' @ ' + str(i))
 
@@ -407,10 +424,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    with args.input.open('rb') as f:
-        skp = json.load(f)
-
-    layer, _ = compile_skp_to_lskia(skp['commands'])
+    layer, _ = compile_skp_to_lskia(stream_skp(args.input))
 
     if args.output:
         with args.output.open('w') as f:
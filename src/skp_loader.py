@@ -0,0 +1,119 @@
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator, Optional, TextIO
+
+CHUNK_SIZE = 1 << 16
+
+WHITESPACE = ' \t\n\r'
+
+
+@dataclass
+class SkpSideTable:
+    """The parts of a JSON SKP that are still needed after compiling it: the
+    paints the renderer reads back by command index, and the canvas size."""
+
+    dim: tuple[int, int] = (512, 512)
+    paints: dict[int, dict[str, Any]] = field(default_factory=dict)
+    number_cmds: int = 0
+    # Every top level entry other than the commands, dim included
+    header: dict[str, Any] = field(default_factory=dict)
+
+
+class Scanner:
+    """Decodes JSON values one at a time from a file that is read in chunks, so
+    only the value being decoded has to be in memory."""
+
+    def __init__(self, f: TextIO):
+        self.f = f
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self) -> bool:
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """The next non-whitespace character, or '' at the end of the file"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars: str) -> str:
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError(f'expected one of {chars!r} in SKP, got {c!r}')
+        self.pos += 1
+        return c
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Most likely the value runs past the end of the buffer
+                if not self.fill():
+                    raise
+                continue
+            # A number might have been cut short by the end of the buffer
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def record(table: Optional[SkpSideTable], i: int, command: dict[str, Any]):
+    if table is not None:
+        if 'paint' in command:
+            table.paints[i] = command['paint']
+        table.number_cmds = max(table.number_cmds, i + 1)
+
+
+def stream_skp(path: Path, table: Optional[SkpSideTable] = None) -> Iterator[dict[str, Any]]:
+    """Yields the commands of a JSON SKP one at a time, without loading the
+    whole file. If a side table is given it is filled in along the way; the
+    canvas size may come after the commands, so it is only complete once the
+    iterator is exhausted."""
+    with path.open('r', encoding='utf-8') as f:
+        scanner = Scanner(f)
+        scanner.expect('{')
+        if scanner.peek() == '}':
+            return
+
+        while True:
+            key = scanner.value()
+            scanner.expect(':')
+            if key == 'commands':
+                scanner.expect('[')
+                i = 0
+                if scanner.peek() == ']':
+                    scanner.expect(']')
+                else:
+                    while True:
+                        command = scanner.value()
+                        record(table, i, command)
+                        yield command
+                        i += 1
+                        if scanner.expect(',]') == ']':
+                            break
+            else:
+                value = scanner.value()
+                if table is not None:
+                    table.header[key] = value
+                    if key == 'dim':
+                        table.dim = (value[0], value[1])
+
+            if scanner.expect(',}') == '}':
+                return
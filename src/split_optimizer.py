@@ -0,0 +1,145 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from egglog_runner import Budget, EgglogResult, EgglogWorker, Stage, start_failed
+from lambda_skia import Draw, Empty, Layer, SaveLayer
+from parse_sexp import parse_sexp
+from peephole import peephole, rewrite_save_layer
+from subproc import Limits
+
+type Runner = Callable[[str, Optional[tuple[Stage, ...]], Optional[Budget], Limits], EgglogResult]
+
+
+class WorkerPool:
+    """egglog workers for running jobs side by side. A worker is started when
+    a job finds none idle with the limits it asks for, and kept for later jobs
+    unless it died."""
+
+    def __init__(self):
+        self.idle: list[EgglogWorker] = []
+        self.lock = threading.Lock()
+
+    def run(
+        self,
+        program: str,
+        schedule: Optional[tuple[Stage, ...]] = None,
+        budget: Optional[Budget] = None,
+        limits: Limits = Limits(),
+    ) -> EgglogResult:
+        with self.lock:
+            worker = next((worker for worker in self.idle if worker.limits == limits), None)
+            if worker is not None:
+                self.idle.remove(worker)
+        if worker is None:
+            try:
+                worker = EgglogWorker(limits=limits)
+            except (OSError, RuntimeError) as e:
+                return start_failed(e)
+
+        result = worker.run(program, schedule, budget)
+        if worker.alive():
+            with self.lock:
+                self.idle.append(worker)
+        return result
+
+    def close(self):
+        """Closes the idle workers and waits for them"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for worker in idle:
+            worker.close()
+
+
+_pool = WorkerPool()
+
+
+def close_workers():
+    """Closes the workers of split runs in this process, see close_worker"""
+    _pool.close()
+
+
+def spine(layer: Layer) -> list[Draw | SaveLayer]:
+    """The Draws and SaveLayers reached by following `bottom` from the root,
+    outermost first. Everything else in the term hangs off these."""
+    nodes: list[Draw | SaveLayer] = []
+    while isinstance(layer, (Draw, SaveLayer)):
+        nodes.append(layer)
+        layer = layer.bottom
+    return nodes
+
+
+def optimize_split(
+    layer: Layer,
+    jobs: int = 2,
+    schedule: Optional[tuple[Stage, ...]] = None,
+    budget: Optional[Budget] = None,
+    limits: Limits = Limits(),
+    run: Runner = _pool.run,
+) -> EgglogResult:
+    """Optimizes a term piecewise. The top of every SaveLayer on the spine is
+    a subterm whose rewrites never depend on what surrounds it. These are
+    rewritten by the peephole rewriter, which on its own can do better than
+    egglog does without the page around them, then optimized as separate
+    e-graphs, `jobs` at a time, and substituted back into the spine. The
+    rules at the spine's own SaveLayers only look at the heads of its bottom
+    and top, so they are applied by the peephole rewriter while the spine is
+    rebuilt. No e-graph ever holds the whole page, so the work grows with the
+    largest top rather than the page.
+
+    The returned result looks like that of a single egglog run. Its output is
+    the final term, and it fails if any of the jobs failed. The schedule,
+    budget and limits apply to each job on its own, and the result records
+    the first budget any of them hit. Its e-graph size is that of the
+    largest job."""
+    start = time.perf_counter()
+    nodes = spine(layer)
+    # Whatever the spine ends in; an Empty for every compiled term
+    rest = nodes[-1].bottom if nodes else layer
+    # Interned, so a top the page repeats is only optimized once
+    parts = list(
+        dict.fromkeys(
+            node.top
+            for node in nodes
+            if isinstance(node, SaveLayer) and not isinstance(node.top, Empty)
+        )
+    )
+    if not isinstance(rest, Empty):
+        parts.append(rest)
+
+    def optimize(part: Layer) -> EgglogResult:
+        return run('(let test ' + peephole(part).sexp() + ')', schedule, budget, limits)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(optimize, parts))
+
+    stderr = ''.join(result.stderr for result in results)
+    for result in results:
+        if result.ret_code != 0:
+            elapsed = time.perf_counter() - start
+            return EgglogResult(result.ret_code, '', stderr, elapsed, killed_by=result.killed_by)
+    optimized = {part: parse_sexp(result.output) for part, result in zip(parts, results)}
+
+    # Rebuild the spine innermost first, with the optimized tops
+    stitched = optimized.get(rest, rest)
+    for node in reversed(nodes):
+        if isinstance(node, SaveLayer):
+            stitched = rewrite_save_layer(stitched, optimized.get(node.top, node.top), node.paint)
+        else:
+            stitched = Draw(stitched, node.shape, node.paint, node.clip, node.transform)
+
+    stats: dict[str, Any] = {'split_jobs': len(parts)}
+    sizes = [
+        result.stats['enodes'] for result in results if result.stats and 'enodes' in result.stats
+    ]
+    if sizes:
+        stats['enodes'] = max(sizes)
+    return EgglogResult(
+        0,
+        stitched.sexp(),
+        stderr,
+        time.perf_counter() - start,
+        stats,
+        next((result.budget for result in results if result.budget), None),
+    )
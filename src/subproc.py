@@ -0,0 +1,120 @@
+import os
+import re
+import resource
+import signal
+import subprocess
+import threading
+from dataclasses import dataclass
+from typing import IO, Optional
+
+# What Rust and Python print when an allocation fails, e.g. under RLIMIT_AS
+ALLOCATION_FAILED = ('memory allocation of', 'MemoryError')
+
+
+@dataclass(frozen=True)
+class Limits:
+    """Resource limits for a child process, None being unlimited. `timeout` is
+    wall clock seconds, `memory` bytes of address space (RLIMIT_AS), `cpu`
+    CPU seconds (RLIMIT_CPU) and `output` the number of characters kept of
+    each of stdout and stderr."""
+
+    timeout: Optional[float] = None
+    memory: Optional[int] = None
+    cpu: Optional[int] = None
+    output: int = 64 * 2**20
+
+
+class CappedBuffer:
+    """Collects text up to `cap` characters and counts what is dropped
+    after that, so a runaway process cannot fill our memory.
+
+    Lines that contain `marker` followed by a number are not collected, but
+    record that the stream got that far, see wait_mark."""
+
+    def __init__(self, cap: int, marker: Optional[str] = None):
+        self.cap = cap
+        self.parts: list[str] = []
+        self.size = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.marker = re.compile(re.escape(marker) + r'(\d+)') if marker else None
+        self.mark = -1
+        self.closed = False
+        self.changed = threading.Condition(self.lock)
+
+    def write(self, text: str):
+        with self.lock:
+            room = self.cap - self.size
+            if room < len(text):
+                self.dropped += len(text) - max(room, 0)
+                text = text[: max(room, 0)]
+            self.parts.append(text)
+            self.size += len(text)
+
+    def drain(self, stream: IO[str]):
+        for line in stream:
+            found = self.marker.search(line) if self.marker else None
+            if found is None:
+                self.write(line)
+                continue
+            with self.changed:
+                self.mark = max(self.mark, int(found[1]))
+                self.changed.notify_all()
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def wait_mark(self, mark: int, timeout: Optional[float] = None) -> bool:
+        """Waits until marker number `mark`, or a later one, was read or the
+        stream ended. False if that took longer than `timeout` seconds."""
+        with self.changed:
+            return self.changed.wait_for(lambda: self.closed or self.mark >= mark, timeout)
+
+    def take(self) -> str:
+        """Returns and clears what was collected"""
+        with self.lock:
+            text = ''.join(self.parts)
+            if self.dropped:
+                text += f'\n[{self.dropped} characters dropped]\n'
+            self.parts.clear()
+            self.size = self.dropped = 0
+        return text
+
+
+def apply_limits(pid: int, limits: Limits):
+    """Caps the memory and CPU time of a running process. Done from the
+    parent with prlimit rather than in a preexec_fn, which is unsafe in a
+    process with threads; where there is no prlimit the limits are skipped."""
+    if not hasattr(resource, 'prlimit'):
+        return
+    try:
+        if limits.memory is not None:
+            resource.prlimit(pid, resource.RLIMIT_AS, (limits.memory, limits.memory))
+        if limits.cpu is not None:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (limits.cpu, limits.cpu + 1))
+    except ProcessLookupError:
+        # It is done already
+        pass
+
+
+def kill_group(proc: subprocess.Popen):
+    """Kills a process started with start_new_session, and anything it
+    spawned in turn"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def classify(ret_code: int, stderr: str, timed_out: bool) -> Optional[str]:
+    """Tells apart a process that ran out of time or memory from one that
+    simply failed. SIGXCPU is what RLIMIT_CPU sends, and a SIGKILL we did not
+    send ourselves is most likely the kernel's OOM killer."""
+    if timed_out or ret_code == -signal.SIGXCPU:
+        return 'timeout'
+    if ret_code == -signal.SIGKILL or (
+        ret_code != 0 and any(message in stderr for message in ALLOCATION_FAILED)
+    ):
+        return 'oom'
+    return None
+
@@ -1,6 +1,9 @@
 import argparse
-import json
+import traceback
 from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from skp_loader import stream_skp
 
 
 def verify_color_filter(colorfilter: dict):
@@ -362,12 +365,42 @@ def verify_command(command):
             raise ValueError(f'Unknown command: {command["command"]}')
 
 
-def verify_skp(commands):
-    for i, command in enumerate(commands['commands']):
-        try:
-            verify_command(command)
-        except Exception:
-            raise ValueError(f'Error at {i}: {command["command"]}')
+def verify_command_at(i: int, command: dict):
+    try:
+        verify_command(command)
+    except Exception:
+        raise ValueError(f'Error at {i}: {command["command"]}')
+
+
+def verify_skp(commands: Iterable[dict]):
+    for i, command in enumerate(commands):
+        verify_command_at(i, command)
+
+
+class Verifier:
+    """Verifies commands as they are passed on, so verification can be fused
+    into the pass that compiles them. Unlike verify_skp, a command that fails
+    does not stop the commands after it from being passed on; the traceback of
+    the first failure is kept in `error`. If the consumer stops early, the rest
+    can be verified by iterating over what is left."""
+
+    def __init__(self, commands: Iterable[dict]):
+        self.commands = iter(commands)
+        self.index = 0
+        self.error: Optional[str] = None
+
+    def __iter__(self) -> Iterator[dict]:
+        return self
+
+    def __next__(self) -> dict:
+        command = next(self.commands)
+        if self.error is None:
+            try:
+                verify_command_at(self.index, command)
+            except ValueError:
+                self.error = traceback.format_exc()
+        self.index += 1
+        return command
 
 
 if __name__ == '__main__':
@@ -377,7 +410,4 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    with args.input.open('rb') as f:
-        skp = json.load(f)
-
-    verify_skp(skp)
+    verify_skp(stream_skp(args.input))
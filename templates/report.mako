@@ -17,6 +17,9 @@
         No. of websites <span class="yellow">Unchanged</span>: ${content['unchanged']}/${content['num_benchmarks']}<br />
         No. of websites <span class="red">Regressed</span>: ${content['regressed']}/${content['num_benchmarks']}<br />
         No. of websites <span>Failed</span>:  ${content['failed']}/${content['num_benchmarks']}
+        % if content.get('timeout') or content.get('oom'):
+            <br />No. of websites egglog ran out of time on: ${content.get('timeout', 0)}/${content['num_benchmarks']}, out of memory on: ${content.get('oom', 0)}/${content['num_benchmarks']}
+        % endif
         <!-- Display the SaveLayer aggregates computed in mk_report.collate_data so the
              summary conveys the overall effect of optimization on successful benches. -->
         <% totals = content.get('savelayer_totals') or {} %>
@@ -27,6 +30,15 @@
             <br />Total SaveLayers (before → after): n/a
             <br />Net SaveLayer change: n/a (no successful benchmarks)
         % endif
+        <% stage_totals = content.get('stage_totals') or {} %>
+        % if stage_totals:
+            <br />Time per stage (s): ${', '.join('%s %.1f' % (stage, ms / 1000) for stage, ms in stage_totals.items() if stage != 'total')}
+            <br />Total time (s): ${'%.1f' % (stage_totals.get('total', 0) / 1000)}, peak RSS: ${'%.0f' % content.get('peak_rss_mb', 0)} MiB
+        % endif
+        <% budgeted = [row['full_name'] for row in content['results'] if row.get('egglog_budget')] %>
+        % if budgeted:
+            <br />Stopped early by an egglog budget: ${len(budgeted)} (${', '.join(budgeted)})
+        % endif
     </p>
     <table class="white-space: nowrap;" data-sortable>
         <thead class="gray">
@@ -38,6 +50,8 @@
                 <th>Diff</th>
                 <th>#SaveLayers</th>
                 <th colspan="3">PNG</th>
+                <th>E-nodes</th>
+                <th>Time (ms)</th>
             </tr>
         </thead>
         <tbody>
@@ -55,7 +69,13 @@
                     <td colspan="6" class="void"></td>
                 % elif row['state'] == 1:
                     <td class="ctr"><a href="${row['pre_file']}">&raquo;</a></td>
-                    <td class="ctr"><a href="${row['egglog_error']}">!</a></td>
+                    % if row.get('killed_by') == 'timeout':
+                        <td class="ctr"><a href="${row['egglog_error']}" title="egglog ran out of time">&#8987;</a></td>
+                    % elif row.get('killed_by') == 'oom':
+                        <td class="ctr"><a href="${row['egglog_error']}" title="egglog ran out of memory">OOM</a></td>
+                    % else:
+                        <td class="ctr"><a href="${row['egglog_error']}">!</a></td>
+                    % endif
                     <td colspan="5" class="void"></td>
                 % elif row['state'] == 2:
                     <td class="ctr"><a href="${row['pre_file']}">&raquo;</a></td>
@@ -84,23 +104,37 @@
                             <a href="${row['post_png_err']}">!</a>
                         % endif
                     </td>
-                    % if 'png_diff' in row:
-                        % if 'png_diff_metric' in row:
-                            % if row['png_diff_metric'] == 0:
-                                <td class="ctr green">
-                            % else:
-                                <td class="ctr red">
-                            % endif
+                    % if 'png_diff_metric' in row:
+                        % if row['png_diff_metric'] == 0:
+                            <td class="ctr green">
                         % else:
-                            <td class="ctr">
+                            <td class="ctr red">
                         % endif
+                        % if 'png_diff' in row:
                             <a href="${row['png_diff']}">&raquo;</a>
+                        % endif
                         </td>
                     % else:
                         <td class="void">
                     % endif
                     </td>
                 % endif
+                <% stats = row.get('egglog_stats', {}) %>
+                % if 'enodes' in stats:
+                    <%
+                        rules = sorted(stats.get('rules', {}).items(), key=lambda r: r[1]['search'] + r[1]['apply'], reverse=True)
+                        slowest = '\n'.join('%.3fs %s' % (r['search'] + r['apply'], rule) for rule, r in rules[:3])
+                    %>
+                    % if row.get('egglog_budget'):
+                        <td class="ctr yellow" data-value="${stats['enodes']}" title="${'stopped by the %s budget\n%s' % (row['egglog_budget'], slowest) | h}">${stats['enodes']}*</td>
+                    % else:
+                        <td class="ctr" data-value="${stats['enodes']}" title="${slowest | h}">${stats['enodes']}</td>
+                    % endif
+                % else:
+                    <td class="void"></td>
+                % endif
+                <% timings = row.get('timings', {}) %>
+                <td class="ctr" data-value="${timings.get('total', 0)}" title="${', '.join('%s %.0fms' % (stage, ms) for stage, ms in timings.items() if stage != 'total')}">${'%.0f' % timings.get('total', 0)}</td>
             </tr>
             % endfor
         </tbody>